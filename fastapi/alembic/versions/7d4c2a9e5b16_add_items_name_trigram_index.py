@@ -0,0 +1,34 @@
+"""Add items name trigram index
+
+Revision ID: 7d4c2a9e5b16
+Revises: 3b8e1f0c7a92
+Create Date: 2026-10-17 10:03:18.927405
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "7d4c2a9e5b16"
+down_revision: Union[str, None] = "3b8e1f0c7a92"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+    op.create_index(
+        "ix_items_name_trgm",
+        "items",
+        ["name"],
+        unique=False,
+        postgresql_using="gin",
+        postgresql_ops={"name": "gin_trgm_ops"},
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_items_name_trgm", table_name="items")
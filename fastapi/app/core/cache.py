@@ -0,0 +1,98 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import TYPE_CHECKING, Generic, Hashable, TypeVar
+from uuid import UUID
+
+from app.core.config import get_settings
+
+if TYPE_CHECKING:
+    from app.endpoints.user.security import TokenData
+    from app.endpoints.user.util import Principal
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+settings = get_settings()
+
+caches: dict[str, "TTLCache"] = {}
+
+
+class TTLCache(Generic[K, V]):
+    """
+    In-process cache whose entries expire `ttl` seconds after being stored.
+    When `maxsize` is given, the least recently used entry is evicted once the cache is full.
+    Every cache is registered by name in `caches` to report its statistics.
+    """
+
+    def __init__(self, name: str, ttl: float, maxsize: int | None = None) -> None:
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        caches[name] = self
+
+    def get(self, key: K) -> V | None:
+        """Returns the value stored for the key, or None if it is missing or expired."""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expire, value = entry
+        if expire <= monotonic():
+            self._data.pop(key, None)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V, ttl: float | None = None) -> None:
+        """Stores the value for the key for `ttl` seconds, or for the `ttl` of the cache if not given."""
+        self._data[key] = (monotonic() + (self.ttl if ttl is None else min(ttl, self.ttl)), value)
+        self._data.move_to_end(key)
+        if self.maxsize is not None and len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *keys: K) -> None:
+        """Removes the given keys from the cache."""
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Removes every entry of the cache."""
+        self._data.clear()
+
+    def stats(self) -> dict[str, int | float | None]:
+        """Returns the size, hits, misses, evictions and hit rate of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+
+
+# Row counts by table name, invalidated by the writes on the table
+count_cache: TTLCache[str, int] = TTLCache("counts", ttl=settings.COUNT_CACHE_TTL)
+
+# (ETag, serialized ResponseItemModel) by item uuid, invalidated by the updates and deletes of the item
+item_cache: TTLCache[UUID, tuple[str, str]] = TTLCache(
+    "items", ttl=settings.ITEM_CACHE_TTL, maxsize=settings.ITEM_CACHE_SIZE
+)
+
+# Authenticated user by uuid for `verify_jwt`, invalidated by the updates and deletes of the user
+principal_cache: "TTLCache[UUID, Principal]" = TTLCache(
+    "principals", ttl=settings.PRINCIPAL_CACHE_TTL, maxsize=settings.PRINCIPAL_CACHE_SIZE
+)
+
+# Decoded token by sha256 digest of the token, each entry expiring with its token
+token_cache: "TTLCache[bytes, TokenData]" = TTLCache(
+    "tokens", ttl=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60, maxsize=settings.TOKEN_CACHE_SIZE
+)
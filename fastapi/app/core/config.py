@@ -19,6 +19,7 @@ class EnvSettings(BaseSettings):
 
     # Logging
     LOG_LEVEL: str = "INFO"
+    QUERY_REPEAT_THRESHOLD: int = 0  # warns when a request runs the same statement more often (N+1), 0 disables
 
     # Database
     DB_NAME: str = "demo"
@@ -26,11 +27,52 @@ class EnvSettings(BaseSettings):
     DB_PASSWORD: SecretStr = SecretStr("demo*123")
     DB_HOST: str = "localhost"
     DB_PORT: str = "5432"
+    DB_POOL_SIZE: int = 5  # connections kept open by each process
+    DB_MAX_OVERFLOW: int = 0  # connections opened beyond DB_POOL_SIZE under load, closed once returned
+    DB_POOL_TIMEOUT: float = 30  # seconds to wait for a connection before failing the request
+    DB_POOL_RECYCLE: int = 300  # seconds after which a connection is replaced
+    DB_POOL_PRE_PING: bool = False
+    DB_QUERY_CACHE_SIZE: int = 500  # SQL strings compiled by SQLAlchemy, shared by the connections of an engine
+    DB_PREPARED_STATEMENT_CACHE_SIZE: int = 100  # statements prepared by each connection, 0 disables
+    DB_PGBOUNCER: bool = False  # behind PgBouncer in transaction mode: no prepared statement cache, unique names
+    DB_WARM_UP: bool = True  # opens the pool and prepares the hot statements after startup, see app.core.warmup
+    # Read replica used by the GET endpoints, disabled when DB_READ_HOST is not set
+    DB_READ_HOST: str | None = None
+    DB_READ_PORT: str | None = None  # defaults to DB_PORT
+    DB_READ_RETRY_INTERVAL: float = 10  # seconds during which the reads go to the primary after a replica failure
+    READ_YOUR_WRITES_SECONDS: float = 0  # seconds during which a client reads from the primary after a write
+    # Request deadlines, applied to the queries as a statement_timeout, see app.core.deadline
+    REQUEST_TIMEOUT: float = 0  # default budget of the requests in seconds, 0 disables
+    REQUEST_TIMEOUT_MAX: float = 60  # upper bound of the budget a client asks with the X-Request-Timeout header
+    # budget of the item listings, whose filter scans the names, 0 keeps REQUEST_TIMEOUT. A budget costs a
+    # set_config round trip per transaction, and so per statement of the read-only sessions
+    ITEMS_SEARCH_TIMEOUT: float = 0
 
     # JWT
     JWT_SECRET: SecretStr = SecretStr("secretdemo")
     JWT_ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60
+    # Trust the role and the epoch signed in the tokens instead of querying the user on each request
+    STATELESS_AUTH: bool = False
+    TOKEN_EPOCH_RELOAD_INTERVAL: float = 30  # seconds between two reloads of the token epochs in stateless mode
+
+    # Password hashing
+    HASHING_WORKERS: int | None = None  # processes hashing the passwords, defaults to the number of cores
+    HASHING_QUEUE_SIZE: int = 64  # jobs waiting for a worker before answering 503
+    IMPORT_HASHING_WORKERS: int = 1  # processes hashing the passwords of the imports, apart from the logins
+
+    # Bulk operations
+    BULK_INSERT_CHUNK_SIZE: int = 1000  # rows per INSERT statement
+    EXPORT_CHUNK_SIZE: int = 1000  # rows fetched from the server side cursor at once
+    IMPORT_MAX_LINES: int = 10_000  # lines of a users import, held in memory until they are written
+
+    # Caches
+    COUNT_CACHE_TTL: float = 30  # seconds
+    ITEM_CACHE_TTL: float = 60  # seconds
+    ITEM_CACHE_SIZE: int = 10_000
+    PRINCIPAL_CACHE_TTL: float = 30  # seconds, delay before a role change or a disabling applies to live tokens
+    PRINCIPAL_CACHE_SIZE: int = 10_000
+    TOKEN_CACHE_SIZE: int = 10_000
 
 
 @lru_cache()
@@ -52,7 +94,12 @@ def initialize_app() -> None:
     return
 
 
-def cleanup_app() -> None:
-    """Clean Up function executed on shutdown"""
+async def cleanup_app() -> None:
+    """Clean Up function executed on shutdown: closes the connections of the pools"""
+    # imported here, app.core.database depends on the settings
+    from app.core.database import engine, read_engine
+
     logger.debug("Cleaning up resources...")
-    return
+    await engine.dispose()
+    if read_engine is not None:
+        await read_engine.dispose()
@@ -1,28 +1,301 @@
+from bisect import bisect_left
+from contextvars import ContextVar
 from datetime import datetime
+from functools import partial
+from hashlib import md5
+from time import monotonic, perf_counter
+from typing import Any, Callable, Coroutine
 from urllib.parse import quote
+from uuid import uuid4
 
-from sqlalchemy import TIMESTAMP
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+from sqlalchemy import TIMESTAMP, event, text
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine, AsyncSession, AsyncAttrs
-from sqlalchemy.orm import DeclarativeBase, MappedAsDataclass
+from sqlalchemy.orm import DeclarativeBase, MappedAsDataclass, Session, SessionTransaction
+from sqlalchemy.pool import AsyncAdaptedQueuePool, ConnectionPoolEntry
+from sqlalchemy.util import greenlet_spawn
 
+from app.core.cache import TTLCache
 from app.core.config import get_settings
+from app.core.deadline import DeadlineExceededError, is_statement_timeout, set_deadline
+from app.core.instrumentation import instrument_engine
 from app.core.logger import logger_factory
 
 logger = logger_factory(__name__)
 settings = get_settings()
-db_url: str = f"postgresql+asyncpg://{settings.DB_USER}:{quote(settings.DB_PASSWORD.get_secret_value())}@{settings.DB_HOST}:{settings.DB_PORT}/{settings.DB_NAME}"
-# server_settings pour améliorer la gestion d'énumérations de la DB (voir https://docs.sqlalchemy.org/en/14/dialects/postgresql.html#disabling-the-postgresql-jit-to-improve-enum-datatype-handling)
-engine: AsyncEngine = create_async_engine(
-    db_url,
-    echo=settings.LOG_LEVEL == "DEBUG",
-    pool_pre_ping=False,
-    pool_recycle=300,  # seconds
-    pool_size=5,
-    max_overflow=0,
-    connect_args={"server_settings": {"jit": "off"}},
-)
+
+
+class PoolMetrics:
+    """Statistics of the checkouts of a connection pool, and of the connections it opened"""
+
+    # upper bounds in seconds of the buckets of the wait histogram, the last bucket holding the longer waits
+    WAIT_BUCKETS = (0.001, 0.01, 0.1, 1.0)
+
+    def __init__(self) -> None:
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_histogram = [0] * (len(self.WAIT_BUCKETS) + 1)
+        self.connects = 0
+        self.connect_total = 0.0
+        self.connect_max = 0.0
+
+    def record(self, wait: float) -> None:
+        """Records the time a checkout waited for a connection, or before timing out."""
+        self.checkouts += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.wait_histogram[bisect_left(self.WAIT_BUCKETS, wait)] += 1
+
+    def record_connect(self, duration: float) -> None:
+        """Records the time the pool took to open a new connection, or to fail to."""
+        self.connects += 1
+        self.connect_total += duration
+        self.connect_max = max(self.connect_max, duration)
+
+    def stats(self) -> dict[str, int | float | dict[str, int]]:
+        """
+        Returns the number of checkouts and timeouts, the average, max and histogram of the waits, and the number,
+        average and max duration of the new connections.
+        """
+        labels = [f"<={bound}s" for bound in self.WAIT_BUCKETS] + [f">{self.WAIT_BUCKETS[-1]}s"]
+        return {
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_avg": self.wait_total / self.checkouts if self.checkouts else 0.0,
+            "wait_max": self.wait_max,
+            "wait_histogram": dict(zip(labels, self.wait_histogram)),
+            "connects": self.connects,
+            "connect_avg": self.connect_total / self.connects if self.connects else 0.0,
+            "connect_max": self.connect_max,
+        }
+
+
+# Time spent opening new connections by the checkout in progress, None outside of the checkouts
+_checkout_connect_time: ContextVar[float | None] = ContextVar("checkout_connect_time", default=None)
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """
+    Connection pool measuring how long each checkout waits for a free connection, and how long the new connections
+    take to open, see :class:`PoolMetrics`. The opening of a connection by a checkout is not counted in its wait, nor
+    is the pre-ping of the connection, which runs once it was taken from the pool.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self) -> ConnectionPoolEntry:
+        if _checkout_connect_time.get() is not None:
+            # the pool retries the checkout, counted by the first call
+            return super()._do_get()
+        start = perf_counter()
+        token = _checkout_connect_time.set(0.0)
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        finally:
+            connect_time = _checkout_connect_time.get() or 0.0
+            _checkout_connect_time.reset(token)
+            self.metrics.record(perf_counter() - start - connect_time)
+
+    def _create_connection(self) -> ConnectionPoolEntry:
+        start = perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            duration = perf_counter() - start
+            self.metrics.record_connect(duration)
+            connect_time = _checkout_connect_time.get()
+            if connect_time is not None:
+                _checkout_connect_time.set(connect_time + duration)
+
+
+def get_pool_stats(engine: AsyncEngine) -> dict[str, int | float | dict[str, int]]:
+    """
+    Returns the state of the connection pool of an engine and the statistics of its checkouts.
+
+    Args:
+        engine: the :class:`AsyncEngine` whose pool to inspect.
+
+    Returns:
+        A `dict` with the size of the pool, the connections in use and idle, and the :class:`PoolMetrics`.
+    """
+    pool = engine.pool
+    stats: dict[str, int | float | dict[str, int]] = {
+        "size": pool.size(),  # type: ignore
+        "in_use": pool.checkedout(),  # type: ignore
+        "idle": pool.checkedin(),  # type: ignore
+        # negative while the pool has not opened all of its `size` connections yet
+        "overflow": max(pool.overflow(), 0),  # type: ignore
+    }
+    if isinstance(pool, InstrumentedPool):
+        stats.update(pool.metrics.stats())
+    return stats
+
+
+def make_db_url(host: str, port: str) -> str:
+    """Returns the URL of the database on the given server, with the credentials of the settings."""
+    return f"postgresql+asyncpg://{settings.DB_USER}:{quote(settings.DB_PASSWORD.get_secret_value())}@{host}:{port}/{settings.DB_NAME}"
+
+
+def prepared_statement_name() -> str:
+    """
+    Names the statements prepared behind PgBouncer with unique names: the server connections are shared by the clients,
+    so the default numbered names of two clients could collide.
+    """
+    return f"__asyncpg_{uuid4()}__"
+
+
+def make_engine(url: str) -> AsyncEngine:
+    """Creates an engine with the pool and cache parameters of the settings, see :func:`instrument_engine`."""
+    connect_args: dict[str, Any] = {"prepared_statement_cache_size": settings.DB_PREPARED_STATEMENT_CACHE_SIZE}
+    if settings.DB_PGBOUNCER:
+        # each transaction may run on another server connection, where the statements prepared before are missing.
+        # PgBouncer also rejects the startup parameters it does not know, like jit
+        connect_args.update(
+            prepared_statement_cache_size=0,
+            statement_cache_size=0,
+            prepared_statement_name_func=prepared_statement_name,
+        )
+    else:
+        # server_settings pour améliorer la gestion d'énumérations de la DB (voir https://docs.sqlalchemy.org/en/14/dialects/postgresql.html#disabling-the-postgresql-jit-to-improve-enum-datatype-handling)
+        connect_args["server_settings"] = {"jit": "off"}
+    async_engine = create_async_engine(
+        url,
+        echo=settings.LOG_LEVEL == "DEBUG",
+        query_cache_size=settings.DB_QUERY_CACHE_SIZE,
+        poolclass=InstrumentedPool,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        connect_args=connect_args,
+    )
+    instrument_engine(async_engine)
+    return async_engine
+
+
+class ReadOnlySession(AsyncSession):
+    """
+    Session of the endpoints that only read. It is never committed: its statements share one read-only transaction,
+    which :meth:`release` ends to give the connection back to the pool as soon as the endpoint returned, instead of
+    holding it until the response is sent, see :class:`ReadSessionRoute`.
+    The async session buffers the rows before returning them, so the loaded objects stay usable after the release.
+    """
+
+    async def release(self) -> None:
+        """Ends the current transaction and returns its connection to the pool, without expiring the objects."""
+        transaction = self.sync_session.get_transaction()
+        if transaction is not None:
+            await greenlet_spawn(transaction.close)
+
+
+class ReadSessionRoute(APIRoute):
+    """
+    Route releasing the :class:`ReadOnlySession` of :func:`get_read_db` once the endpoint returned and its response
+    was serialized. The dependencies only exit after the response is sent, which would hold the connection meanwhile.
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        route_handler = super().get_route_handler()
+
+        async def release_read_session(request: Request) -> Response:
+            try:
+                return await route_handler(request)
+            finally:
+                session_local: ReadOnlySession | None = getattr(request.state, "read_db", None)
+                if session_local is not None:
+                    await session_local.release()
+
+        return release_read_session
+
+
+def make_read_only(engine: AsyncEngine) -> async_sessionmaker[ReadOnlySession]:
+    """Returns a factory of :class:`ReadOnlySession` whose transactions start with `BEGIN READ ONLY`."""
+    return async_sessionmaker(
+        bind=engine.execution_options(postgresql_readonly=True), class_=ReadOnlySession, expire_on_commit=False
+    )
+
+
+db_url: str = make_db_url(settings.DB_HOST, settings.DB_PORT)
+engine: AsyncEngine = make_engine(db_url)
 
 async_session: async_sessionmaker[AsyncSession] = async_sessionmaker(bind=engine, expire_on_commit=False)  # type: ignore
+async_read_only_session: async_sessionmaker[ReadOnlySession] = make_read_only(engine)
+
+# Optional read replica, see get_read_db
+read_engine: AsyncEngine | None = (
+    make_engine(make_db_url(settings.DB_READ_HOST, settings.DB_READ_PORT or settings.DB_PORT))
+    if settings.DB_READ_HOST
+    else None
+)
+async_read_session: async_sessionmaker[ReadOnlySession] | None = make_read_only(read_engine) if read_engine else None
+
+
+class ReplicaStatus:
+    """Keeps the reads on the primary for `DB_READ_RETRY_INTERVAL` seconds after the replica failed"""
+
+    def __init__(self) -> None:
+        self.unavailable_until = 0.0
+        self.failures = 0
+
+    def is_available(self) -> bool:
+        return monotonic() >= self.unavailable_until
+
+    def mark_unavailable(self) -> None:
+        self.failures += 1
+        self.unavailable_until = monotonic() + settings.DB_READ_RETRY_INTERVAL
+
+
+replica_status = ReplicaStatus()
+
+# Clients that wrote recently, to send their reads to the primary (read-your-writes)
+recent_writes: TTLCache[str, bool] = TTLCache("recent_writes", ttl=settings.READ_YOUR_WRITES_SECONDS, maxsize=10_000)
+
+
+def client_key(request: Request) -> str:
+    """Identifies the client of a request by his bearer token, or by his address for the anonymous requests."""
+    client = request.headers.get("authorization") or (request.client.host if request.client else "")
+    return md5(client.encode(), usedforsecurity=False).hexdigest()
+
+
+async def read_session(request: Request | None = None) -> ReadOnlySession:
+    """
+    Creates a read-only session on the read replica, or on the primary when no replica is configured, when the replica
+    failed recently, or when the client of the request wrote recently.
+    A session on the replica first runs a query, which starts its transaction: when the replica cannot be reached or
+    its pooled connection was broken, the session falls back to the primary, and so do the next ones for
+    `DB_READ_RETRY_INTERVAL` seconds. The sessions on the replica are marked with `info["replica"]`.
+
+    Args:
+        request: the request the session is for, if any, to apply the read-your-writes window.
+
+    Returns:
+        A :class:`ReadOnlySession` instance.
+    """
+    if async_read_session is None or not replica_status.is_available():
+        return async_read_only_session()
+    if request is not None and settings.READ_YOUR_WRITES_SECONDS and recent_writes.get(client_key(request)):
+        return async_read_only_session()
+    session_local = async_read_session()
+    session_local.info["replica"] = True
+    try:
+        # a round trip, as a checkout alone does not see a broken connection without pool_pre_ping
+        await session_local.execute(text("SELECT 1"))
+    except (OSError, DBAPIError) as e:
+        logger.warning(f"Read replica unavailable, falling back to the primary: {e!r}")
+        replica_status.mark_unavailable()
+        await session_local.close()
+        return async_read_only_session()
+    return session_local
 
 
 # MappedAsDataclass details : https://docs.sqlalchemy.org/en/20/orm/dataclasses.html#orm-declarative-native-dataclasses
@@ -32,17 +305,90 @@ class Base(DeclarativeBase, MappedAsDataclass, AsyncAttrs):
     }
 
 
-async def get_db():
+def on_commit(db: AsyncSession, func: Callable[..., Any], *args: Any) -> None:
+    """
+    Calls `func(*args)` once the transaction of the session is committed, and never if it is rolled back.
+    The in-process caches and tables mirroring the database are updated this way: :func:`get_db` only commits after
+    the response is sent, and a concurrent read done before the commit would otherwise store the old rows again.
+
+    Args:
+        db: the session whose transaction must be committed first.
+        func: the function to call, such as the `invalidate` method of a cache.
+        args: the arguments of the function.
+    """
+    db.info.setdefault("on_commit", []).append(partial(func, *args))
+
+
+@event.listens_for(Session, "after_commit")
+def _run_on_commit(session: Session) -> None:
+    for callback in session.info.pop("on_commit", []):
+        callback()
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _discard_on_commit(session: Session, transaction: SessionTransaction) -> None:
+    # rolled back or closed without a commit
+    if transaction.parent is None:
+        session.info.pop("on_commit", None)
+
+
+async def get_db(request: Request):
     """
     A function for dependency injection of an :class:`AsyncSession` instance. This function also commits and rollbacks the transaction on error.
+    The queries are cancelled by Postgres once the deadline of the request expired, see :mod:`app.core.deadline`.
 
     Return:
         yields a :class:`AsyncSession` instance to connect to the database for a transaction.
     """
+    if settings.READ_YOUR_WRITES_SECONDS and request.method not in ("GET", "HEAD", "OPTIONS"):
+        # marked before the write: the dependency only exits after the response is sent
+        recent_writes.set(client_key(request), True)
     async with async_session() as session_local:  # type: ignore
+        set_deadline(session_local.sync_session, request)
         try:
             yield session_local
             await session_local.commit()
         except Exception as e:
             await session_local.rollback()
+            if isinstance(e, DBAPIError) and is_statement_timeout(e):
+                raise DeadlineExceededError("The request deadline expired during a query") from e
             raise
+
+
+async def get_read_db(request: Request):
+    """
+    A function for dependency injection of a :class:`ReadOnlySession` instance for the endpoints that only read.
+    The session is bound to the read replica if one is configured, or to the primary, see :func:`read_session`.
+    The session is not committed: the routes of the endpoints using it are :class:`ReadSessionRoute`, which end its
+    transaction once the endpoint returned.
+
+    Return:
+        yields a :class:`ReadOnlySession` instance to connect to the database.
+    """
+    session_local = await read_session(request)
+    set_deadline(session_local.sync_session, request)
+    request.state.read_db = session_local
+    async with session_local:
+        try:
+            yield session_local
+        except DBAPIError as e:
+            if is_statement_timeout(e):
+                raise DeadlineExceededError("The request deadline expired during a query") from e
+            raise
+
+
+async def get_estimated_count(db: AsyncSession, table_name: str) -> int | None:
+    """
+    Reads the planner's estimate of the number of rows of a table from `pg_class.reltuples`. This is a cheap catalog lookup
+    instead of a full scan, kept up to date by VACUUM and ANALYZE.
+
+    Args:
+        db: The :class:`AsyncSession` to connect to the database.
+        table_name: the name of the table to estimate.
+
+    Returns:
+        The estimated number of rows as an integer, or None if the table was never analyzed.
+    """
+    statement = text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table_name)")
+    result = await db.scalar(statement, {"table_name": table_name})
+    return result if result is not None and result >= 0 else None
@@ -0,0 +1,100 @@
+from time import monotonic
+from typing import Any, Callable, Coroutine
+
+from fastapi import Request
+from sqlalchemy import bindparam, event, func, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session, SessionTransaction
+
+from app.core.config import get_settings
+
+settings = get_settings()
+
+TIMEOUT_HEADER = "x-request-timeout"
+
+# SQLSTATE of the statements cancelled by statement_timeout
+QUERY_CANCELED = "57014"
+
+# SET LOCAL statement_timeout with a bound value, to compile and prepare the statement once for every timeout
+SET_STATEMENT_TIMEOUT = select(func.set_config("statement_timeout", bindparam("timeout"), True))
+
+
+class DeadlineExceededError(Exception):
+    """Raised when the database work of a request outlives its budget"""
+
+
+def route_timeout(seconds: float) -> Callable[[Request], Coroutine[Any, Any, None]]:
+    """
+    Returns a dependency giving a route its own budget, instead of `REQUEST_TIMEOUT`.
+    It must be listed in the `dependencies` of the route, so that it runs before the first query.
+
+    Args:
+        seconds: the budget of the route, 0 to keep `REQUEST_TIMEOUT`.
+
+    Returns:
+        The dependency to pass to :func:`fastapi.Depends`.
+    """
+
+    async def set_route_timeout(request: Request) -> None:
+        request.state.timeout = seconds
+
+    return set_route_timeout
+
+
+def request_budget(request: Request) -> float | None:
+    """
+    Returns the budget of the request in seconds: the one of its route or `REQUEST_TIMEOUT`, lowered by the
+    `X-Request-Timeout` header when the client gives up sooner. The header is capped at `REQUEST_TIMEOUT_MAX`.
+    Returns None when the request has no budget.
+    """
+    budget = getattr(request.state, "timeout", None) or settings.REQUEST_TIMEOUT or None
+    try:
+        asked = float(request.headers.get(TIMEOUT_HEADER, ""))
+    except ValueError:
+        asked = 0
+    if not asked > 0:  # missing, invalid or NaN
+        return budget
+    asked = min(asked, settings.REQUEST_TIMEOUT_MAX)
+    return min(budget, asked) if budget else asked
+
+
+class Deadline:
+    """Deadline of the database work of a request, counted from the creation of its session"""
+
+    def __init__(self, request: Request) -> None:
+        self.request = request
+        self.started = monotonic()
+
+    def remaining(self) -> float | None:
+        """Returns the seconds left before the deadline, or None if the request has no budget."""
+        budget = request_budget(self.request)
+        return None if budget is None else self.started + budget - monotonic()
+
+
+def set_deadline(session: Session, request: Request) -> None:
+    """Applies the deadline of the request to the transactions of the session, see :func:`_set_statement_timeout`."""
+    session.info["deadline"] = Deadline(request)
+
+
+def is_statement_timeout(error: DBAPIError) -> bool:
+    """Tells whether the database cancelled the statement because of its statement_timeout."""
+    return getattr(error.orig, "sqlstate", None) == QUERY_CANCELED
+
+
+@event.listens_for(Session, "after_begin")
+def _set_statement_timeout(session: Session, transaction: SessionTransaction, connection: Connection) -> None:
+    """
+    Sets the statement_timeout of each transaction of a session with a deadline to the time left, so that Postgres
+    cancels the queries the client will not wait for. The budget is read when the transaction begins, once the
+    dependencies of the route have run.
+    """
+    deadline: Deadline | None = session.info.get("deadline")
+    if deadline is None:
+        return
+    remaining = deadline.remaining()
+    if remaining is None:
+        return
+    if remaining <= 0:
+        raise DeadlineExceededError("The request deadline expired before the query")
+    connection.execute(SET_STATEMENT_TIMEOUT, {"timeout": str(max(int(remaining * 1000), 1))})
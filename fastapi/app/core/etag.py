@@ -0,0 +1,47 @@
+from datetime import datetime
+from hashlib import md5
+from typing import Iterable
+from uuid import UUID
+
+from fastapi import Response
+
+Version = tuple[UUID, datetime]
+
+
+def make_etag(versions: Iterable[Version]) -> str:
+    """
+    Creates a strong ETag from the `(id, updated_on)` pairs of the rows a response is made of.
+
+    Args:
+        versions: the `(id, updated_on)` pairs of the rows, in any order.
+
+    Returns:
+        The quoted ETag as a `str`.
+    """
+    digest = md5(usedforsecurity=False)
+    for uuid, updated_on in sorted(versions):
+        digest.update(f"{uuid}@{updated_on.isoformat()};".encode())
+    return f'"{digest.hexdigest()}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """
+    Checks an `If-None-Match` header against the current ETag of the resource (weak comparison).
+
+    Args:
+        if_none_match: the value of the `If-None-Match` header, if any.
+        etag: the current ETag of the resource.
+
+    Returns:
+        True if the client's copy is up to date.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    """Returns an empty `304 Not Modified` response carrying the ETag."""
+    return Response(status_code=304, headers={"ETag": etag})
@@ -1,10 +1,12 @@
 from fastapi import Request, FastAPI
 from fastapi.responses import JSONResponse
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeoutError
 
 from sqlalchemy.dialects.postgresql.asyncpg import AsyncAdapt_asyncpg_dbapi
 
+from app.core.deadline import DeadlineExceededError
 from app.core.logger import logger_factory
+from app.core.workers import PoolSaturatedError
 
 logger = logger_factory(__name__)
 
@@ -38,3 +40,20 @@ def register_exception_handlers(app: FastAPI) -> None:
             }
             return JSONResponse(status_code=400, content=content)
         return JSONResponse(status_code=500, content="Internal Server Error")
+
+    @app.exception_handler(PoolSaturatedError)
+    async def PoolSaturatedError_handler(request: Request, exc: PoolSaturatedError) -> JSONResponse:
+        logger.warning(str(exc))
+        content = {"detail": "Server busy, retry later"}
+        return JSONResponse(status_code=503, content=content, headers={"Retry-After": "1"})
+
+    @app.exception_handler(PoolTimeoutError)
+    async def PoolTimeoutError_handler(request: Request, exc: PoolTimeoutError) -> JSONResponse:
+        logger.warning("Timed out waiting for a database connection")
+        content = {"detail": "Server busy, retry later"}
+        return JSONResponse(status_code=503, content=content, headers={"Retry-After": "1"})
+
+    @app.exception_handler(DeadlineExceededError)
+    async def DeadlineExceededError_handler(request: Request, exc: DeadlineExceededError) -> JSONResponse:
+        logger.warning(f"{request.method} {request.url.path}: {exc}")
+        return JSONResponse(status_code=504, content={"detail": "Request deadline exceeded"})
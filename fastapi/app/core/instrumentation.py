@@ -0,0 +1,195 @@
+import re
+from collections import Counter
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Any, Callable
+
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Dialect, ExecutionContext
+from sqlalchemy.engine.interfaces import CacheStats
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core.config import get_settings
+from app.core.logger import logger_factory
+
+logger = logger_factory(__name__)
+settings = get_settings()
+
+SERVER_TIMING_HEADER = "server-timing"
+
+# Bound parameters, and the lists of them rendered by the IN clauses
+_PARAMETERS = re.compile(r"\$\d+(::[\w\[\]]+)?")
+_PARAMETER_LISTS = re.compile(r"\?(, \?)+")
+
+
+def statement_shape(statement: str) -> str:
+    """Returns the statement with its parameters replaced by `?`, whatever the length of its IN lists."""
+    return _PARAMETER_LISTS.sub("?", _PARAMETERS.sub("?", statement))
+
+
+class QueryStats:
+    """Statements run and time spent in the database by one request"""
+
+    def __init__(self) -> None:
+        self.statements = 0
+        self.db_time = 0.0
+        self.shapes: Counter[str] = Counter()
+
+    def record(self, statement: str, duration: float) -> None:
+        self.statements += 1
+        self.db_time += duration
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold: int) -> list[tuple[str, int]]:
+        """Returns the statements run more than `threshold` times, a sign of N+1 queries."""
+        return [(shape, count) for shape, count in self.shapes.most_common() if count > threshold]
+
+
+class PreparedStatementCounter:
+    """
+    Name function of the statements prepared by one asyncpg connection, see the `prepared_statement_name_func` argument
+    of the asyncpg dialect. The adapter calls it each time it prepares a statement, that is on each miss of the prepared
+    statement cache of the connection: it counts them, then defers to the name function of the engine, if any.
+    """
+
+    def __init__(self, name_func: Callable[[], str] | None) -> None:
+        self.name_func = name_func
+        self.prepared = 0
+
+    def __call__(self) -> str | None:
+        self.prepared += 1
+        return self.name_func() if self.name_func is not None else None
+
+
+class StatementCacheStats:
+    """
+    Hits and misses of the statement caches of all the engines: the SQL strings compiled by SQLAlchemy, shared by the
+    connections of an engine, and the statements prepared by each asyncpg connection. Both are counted on the lookups
+    of the statements run through a cursor: the executemany and the COPY do not use the prepared statement cache.
+    A statement run without preparing a new one was found in the cache of its connection, see
+    :class:`PreparedStatementCounter`. Without a cache, as behind PgBouncer, every statement is prepared again.
+    """
+
+    def __init__(self) -> None:
+        self.compiled_hits = 0
+        self.compiled_misses = 0
+        self.prepared_hits = 0
+        self.prepared_misses = 0
+
+    def stats(self, engine: AsyncEngine) -> dict[str, dict[str, int | float | None]]:
+        """Returns the statistics of the caches, with the size of the compiled cache of the engine."""
+        compiled_lookups = self.compiled_hits + self.compiled_misses
+        prepared_lookups = self.prepared_hits + self.prepared_misses
+        compiled_cache = engine.sync_engine._compiled_cache
+        return {
+            "compiled_statements": {
+                "size": len(compiled_cache) if compiled_cache is not None else 0,
+                "maxsize": settings.DB_QUERY_CACHE_SIZE,
+                "hits": self.compiled_hits,
+                "misses": self.compiled_misses,
+                "hit_rate": self.compiled_hits / compiled_lookups if compiled_lookups else None,
+            },
+            "prepared_statements": {
+                "maxsize": settings.DB_PREPARED_STATEMENT_CACHE_SIZE if not settings.DB_PGBOUNCER else 0,
+                "hits": self.prepared_hits,
+                "misses": self.prepared_misses,
+                "hit_rate": self.prepared_hits / prepared_lookups if prepared_lookups else None,
+            },
+        }
+
+
+statement_cache = StatementCacheStats()
+
+# Stats of the request being served, None outside of the requests (startup, background tasks)
+query_stats: ContextVar[QueryStats | None] = ContextVar("query_stats", default=None)
+
+
+def _count_prepared_statements(dialect: Dialect, conn_rec: Any, cargs: Any, cparams: dict[str, Any]) -> None:
+    counter = PreparedStatementCounter(cparams.get("prepared_statement_name_func"))
+    cparams["prepared_statement_name_func"] = counter
+    conn_rec.info["prepared_statements"] = counter
+
+
+def _before_cursor_execute(
+    conn: Connection, cursor: Any, statement: str, parameters: Any, context: ExecutionContext, executemany: bool
+) -> None:
+    if context.cache_hit is CacheStats.CACHE_HIT:
+        statement_cache.compiled_hits += 1
+    elif context.cache_hit is CacheStats.CACHE_MISS:
+        statement_cache.compiled_misses += 1
+    counter: PreparedStatementCounter | None = conn.info.get("prepared_statements")
+    context._prepared_before = counter.prepared if counter is not None and not executemany else None  # type: ignore
+    context._query_start = perf_counter()  # type: ignore
+
+
+def _after_cursor_execute(
+    conn: Connection, cursor: Any, statement: str, parameters: Any, context: ExecutionContext, executemany: bool
+) -> None:
+    prepared_before: int | None = context._prepared_before  # type: ignore
+    if prepared_before is not None:
+        if conn.info["prepared_statements"].prepared > prepared_before:
+            statement_cache.prepared_misses += 1
+        else:
+            statement_cache.prepared_hits += 1
+    stats = query_stats.get()
+    if stats is not None:
+        stats.record(statement, perf_counter() - context._query_start)  # type: ignore
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """
+    Records the statements of the engine, and of its execution option variants, in the current request stats, and the
+    lookups of its statement caches in :data:`statement_cache`.
+    """
+    event.listen(engine.sync_engine, "do_connect", _count_prepared_statements)
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class QueryStatsMiddleware:
+    """
+    ASGI middleware collecting the :class:`QueryStats` of each HTTP request.
+    The statements run before the response starts are reported in the `Server-Timing` header. The log line written
+    once the response is sent also counts the commits of the dependencies, which only exit after the response.
+    When `QUERY_REPEAT_THRESHOLD` is set, a warning lists the statements the request ran more often than that.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = QueryStats()
+        token = query_stats.set(stats)
+        start = perf_counter()
+        status = 500
+
+        async def send_with_timing(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = MutableHeaders(scope=message)
+                headers.append(
+                    SERVER_TIMING_HEADER,
+                    f'db;dur={stats.db_time * 1000:.2f};desc="{stats.statements} queries", '
+                    f"app;dur={(perf_counter() - start) * 1000:.2f}",
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            query_stats.reset(token)
+            logger.info(
+                f"method={scope['method']} path={scope['path']} status={status} queries={stats.statements} "
+                f"db_ms={stats.db_time * 1000:.2f} total_ms={(perf_counter() - start) * 1000:.2f}"
+            )
+            if settings.QUERY_REPEAT_THRESHOLD:
+                for shape, count in stats.repeated(settings.QUERY_REPEAT_THRESHOLD):
+                    logger.warning(
+                        f"Possible N+1 queries: {scope['method']} {scope['path']} ran {count} times: {shape[:200]}"
+                    )
@@ -0,0 +1,48 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from datetime import datetime
+from uuid import UUID
+
+Cursor = tuple[datetime, UUID]
+
+CURSOR_SEPARATOR = "|"
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+# Largest page a listing endpoint returns
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(created_on: datetime, uuid: UUID) -> str:
+    """
+    Encodes the keyset of a row into an opaque cursor string.
+
+    Args:
+        created_on: the creation date of the last row of the page.
+        uuid: the uuid primary key of the last row of the page.
+
+    Returns:
+        An url safe `str` to give back to the client.
+    """
+    raw = f"{created_on.isoformat()}{CURSOR_SEPARATOR}{uuid}"
+    return urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Cursor:
+    """
+    Decodes a cursor created by :func:`encode_cursor`.
+
+    Args:
+        cursor: the opaque cursor string sent by the client.
+
+    Returns:
+        The keyset `(created_on, id)` stored in the cursor.
+
+    Raises:
+        ValueError: when the cursor is malformed.
+    """
+    try:
+        raw = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_on, uuid = raw.split(CURSOR_SEPARATOR)
+        return datetime.fromisoformat(created_on), UUID(uuid)
+    except (BinasciiError, UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
@@ -0,0 +1,68 @@
+from functools import lru_cache
+from typing import Iterable, Optional, TypeVar
+
+from pydantic import BaseModel, TypeAdapter, create_model
+
+M = TypeVar("M", bound=BaseModel)
+
+# Always selected, even when not requested : they are needed for the ETags and the pagination cursors
+KEY_FIELDS = frozenset({"id", "created_on", "updated_on"})
+
+
+def parse_fields(fields: str | None, model: type[BaseModel]) -> frozenset[str] | None:
+    """
+    Parses the `fields` query parameter, a comma separated list of field names.
+
+    Args:
+        fields: the value of the query parameter, if any.
+        model: the response model the fields are picked from.
+
+    Returns:
+        The requested field names, or None if every field is requested.
+
+    Raises:
+        ValueError: when a field does not exist in the model.
+    """
+    if not fields:
+        return None
+    requested = frozenset(field.strip() for field in fields.split(",") if field.strip())
+    unknown = requested - model.model_fields.keys()
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return requested or None
+
+
+def selected_fields(fields: frozenset[str]) -> list[str]:
+    """Returns the names of the columns to select for the requested fields, in a stable order."""
+    return sorted(fields | KEY_FIELDS)
+
+
+def output_fields(fields: frozenset[str], expand: Iterable[str] = ()) -> set[str]:
+    """Returns the fields to serialize for the requested fields and relationships. The id is always returned."""
+    return set(fields | {"id"}).union(expand)
+
+
+@lru_cache(maxsize=128)
+def projection_model(model: type[M], fields: frozenset[str]) -> type[M]:
+    """
+    Creates a subclass of the model where the fields that are not selected are optional, so that it can be validated
+    from rows holding only the selected columns.
+
+    Args:
+        model: the full response model.
+        fields: the requested field names.
+
+    Returns:
+        The projection model, cached for each set of fields.
+    """
+    keep = fields | KEY_FIELDS
+    optional = {
+        name: (Optional[info.annotation], None) for name, info in model.model_fields.items() if name not in keep
+    }
+    return create_model(f"{model.__name__}Projection", __base__=model, **optional)  # type: ignore
+
+
+@lru_cache(maxsize=128)
+def projection_adapter(model: type[M], fields: frozenset[str]) -> TypeAdapter[list[M]]:
+    """Returns the cached `TypeAdapter` validating a list of :func:`projection_model` in one call."""
+    return TypeAdapter(list[projection_model(model, fields)])
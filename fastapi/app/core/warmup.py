@@ -0,0 +1,88 @@
+import asyncio
+from time import perf_counter
+from typing import Awaitable, Callable, Sequence
+
+from fastapi import FastAPI
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession
+
+from app.core.logger import logger_factory
+
+logger = logger_factory(__name__)
+
+# Runs the hot statements of an endpoint package once, see the `warm_up` functions of the repositories
+WarmUpStatements = Callable[[AsyncSession], Awaitable[None]]
+
+
+async def open_connections(engine: AsyncEngine, count: int) -> list[AsyncConnection]:
+    """
+    Checks out `count` connections of the engine at the same time, so that the pool opens them.
+
+    Raises:
+        Exception: the first connection error, once the connections already opened are returned to the pool.
+    """
+    results = await asyncio.gather(*(engine.connect() for _ in range(count)), return_exceptions=True)
+    connections = [result for result in results if isinstance(result, AsyncConnection)]
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        for connection in connections:
+            await connection.close()
+        raise errors[0]
+    return connections
+
+
+async def warm_up_connection(connection: AsyncConnection, statements: Sequence[WarmUpStatements]) -> None:
+    """Runs the hot statements on the connection, in a transaction that is rolled back."""
+    async with AsyncSession(bind=connection) as db:
+        for run in statements:
+            await run(db)
+        await db.rollback()
+
+
+class WarmUp:
+    """
+    Warm-up of the application, run in the background after startup. Every connection of the pools is opened and runs
+    the hot statements once: this pays the connects, the type introspection of asyncpg, the compilation of the
+    statements by SQLAlchemy and their preparation by each connection before the first requests.
+    The OpenAPI schema is built too. The application is ready once it is done, even if the database could not be
+    reached: the warm-up only saves time to the first requests.
+    """
+
+    def __init__(self) -> None:
+        self.ready = False
+        self.duration: float | None = None
+        self._task: asyncio.Task | None = None
+
+    async def run(self, app: FastAPI, engines: Sequence[AsyncEngine], statements: Sequence[WarmUpStatements]) -> None:
+        start = perf_counter()
+        try:
+            for engine in engines:
+                connections = await open_connections(engine, engine.pool.size())  # type: ignore
+                try:
+                    await asyncio.gather(*(warm_up_connection(connection, statements) for connection in connections))
+                finally:
+                    for connection in connections:
+                        await connection.close()
+        except Exception as e:
+            logger.error(f"Failed to warm up the database connections: {e!r}")
+        app.openapi()
+        self.duration = perf_counter() - start
+        self.ready = True
+        logger.info(f"Warm-up done in {self.duration:.3f}s")
+
+    def start(self, app: FastAPI, engines: Sequence[AsyncEngine], statements: Sequence[WarmUpStatements]) -> None:
+        """Starts the warm-up in the background."""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(app, engines, statements))
+
+    async def stop(self) -> None:
+        """Cancels the warm-up if it is still running."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+warm_up = WarmUp()
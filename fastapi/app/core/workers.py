@@ -0,0 +1,82 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
+from typing import Any, Callable, TypeVar
+
+from app.core.config import get_settings
+from app.core.logger import logger_factory
+
+T = TypeVar("T")
+
+logger = logger_factory(__name__)
+settings = get_settings()
+
+# seconds between two checks of a saturated pool by the jobs waiting for it
+SATURATED_POLL_INTERVAL = 0.05
+
+
+class PoolSaturatedError(Exception):
+    """Raised when a :class:`ProcessPool` already holds as many jobs as it accepts"""
+
+
+class ProcessPool:
+    """
+    Process pool running CPU bound work out of the event loop.
+    At most `max_workers + max_pending` jobs are in flight: beyond that, :class:`PoolSaturatedError` is raised
+    instead of queueing the work without bound.
+    """
+
+    def __init__(self, name: str, max_workers: int | None = None, max_pending: int = 0) -> None:
+        self.name = name
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.in_flight = 0
+        self._executor: ProcessPoolExecutor | None = None
+
+    def start(self) -> None:
+        """Creates the executor. The workers are spawned rather than forked from the running server."""
+        if self._executor is None:
+            logger.debug(f"Starting the {self.name} pool with {self.max_workers} workers")
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=get_context("spawn"))
+
+    def shutdown(self) -> None:
+        """Waits for the running jobs and stops the workers."""
+        if self._executor is not None:
+            logger.debug(f"Shutting down the {self.name} pool")
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, func: Callable[..., T], *args: Any, wait: bool = False) -> T:
+        """
+        Runs the function in a worker process and waits for its result without blocking the event loop.
+
+        Args:
+            func: a picklable function, defined at the top level of a module.
+            args: the picklable arguments of the function.
+            wait: when the pool is saturated, waits for a job to finish instead of raising. Meant for the batch jobs,
+                which must slow down rather than fail, while the requests of the users fail fast.
+
+        Returns:
+            The result of the function.
+
+        Raises:
+            PoolSaturatedError: when the pool already holds `max_workers + max_pending` jobs and `wait` is False.
+        """
+        while self.in_flight >= self.max_workers + self.max_pending:
+            if not wait:
+                raise PoolSaturatedError(f"The {self.name} pool is saturated")
+            await asyncio.sleep(SATURATED_POLL_INTERVAL)
+        self.start()
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args))
+        finally:
+            self.in_flight -= 1
+
+
+# bcrypt hashes and verifications of the passwords, see app.endpoints.user.security
+hashing_pool = ProcessPool("hashing", max_workers=settings.HASHING_WORKERS, max_pending=settings.HASHING_QUEUE_SIZE)
+# bcrypt hashes of the users imports, kept apart so that the logins never wait behind a batch
+import_hashing_pool = ProcessPool("import_hashing", max_workers=settings.IMPORT_HASHING_WORKERS)
@@ -1,67 +1,243 @@
-from typing import Sequence
-from uuid import UUID
+from datetime import datetime
+from typing import AsyncIterator, Sequence
+from uuid import UUID, uuid4
 
-from sqlalchemy import func
-from sqlalchemy import select
+from sqlalchemy import Column, Row, Select, func
+from sqlalchemy import select, insert, update, delete, any_, bindparam, tuple_, Uuid
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import InstrumentedAttribute
 
-from app.core.database import AsyncSession
+from app.core.config import get_settings
+from app.core.database import AsyncSession, get_estimated_count
 from app.core.logger import logger_factory
+from app.core.pagination import Cursor
 from app.endpoints.item.util import ItemSchema, CreateItemModel, UpdateItemModel
 
 logger = logger_factory(__name__)
 
 
-async def get_items(db: AsyncSession, filter: str, offset: int, limit: int) -> Sequence[ItemSchema]:
+# Statements of the hot paths, built once: their cache key is memoized, so that each call only binds the parameters
+ITEM_UPDATED_ON = select(ItemSchema.updated_on).where(ItemSchema.id == bindparam("uuid"))
+
+# Bind parameters a single statement can carry in the PostgreSQL protocol
+MAX_BIND_PARAMETERS = 32767
+
+
+def item_columns(columns: list[str]) -> list[Column]:
+    """Returns the columns of the items table with the given names, to select only part of the row."""
+    return [ItemSchema.__table__.c[name] for name in columns]
+
+
+def paginate_items(
+    statement: Select,
+    filter: str,
+    offset: int,
+    limit: int,
+    after: Cursor | None = None,
+    user_id: UUID | None = None,
+) -> Select:
     """
-    Repository layer function to retreive items stored in the database.
+    Applies the filter and the pagination of the items listing to a statement selecting from the items table.
+
+    Args:
+        statement: the :class:`Select` statement to paginate.
+        filter: a string to emit a filter on the database query.
+        offset: an int to emit an offset on the database query. Ignored when `after` is given.
+        limit: an int to emit a limit on the database query.
+        after: the keyset `(created_on, id)` of the last item of the previous page for keyset pagination.
+        user_id: if given, only the items of this user are selected.
+
+    Returns:
+        The statement ordered by `(created_on, id)`, filtered and limited.
+    """
+    statement = statement.order_by(ItemSchema.created_on, ItemSchema.id).limit(limit)
+    if filter:
+        statement = statement.where(ItemSchema.name.contains(filter))
+    if user_id is not None:
+        statement = statement.where(ItemSchema.user_id == user_id)
+    if after is not None:
+        statement = statement.where(tuple_(ItemSchema.created_on, ItemSchema.id) > after)
+    else:
+        statement = statement.offset(offset)
+    return statement
+
+
+async def get_items(
+    db: AsyncSession,
+    filter: str,
+    offset: int,
+    limit: int,
+    after: Cursor | None = None,
+    user_id: UUID | None = None,
+    columns: list[str] | None = None,
+) -> Sequence[ItemSchema] | Sequence[Row]:
+    """
+    Repository layer function to retreive items stored in the database, ordered by `(created_on, id)`.
 
     Args:
         db: The :class:`AsyncSession` to connect to the database.
         filter: a string to emit a filter on the database query.
-        offset: an int to emit an offset on the database query.
+        offset: an int to emit an offset on the database query. Ignored when `after` is given.
         limit: an int to emit a limit on the database query.
+        after: the keyset `(created_on, id)` of the last item of the previous page for keyset pagination.
+        user_id: if given, only the items of this user are returned.
+        columns: if given, only these columns are selected and rows are returned instead of :class:`ItemSchema`.
+
+    Returns:
+        A sequence of :class:`ItemSchema`, or of :class:`Row` when `columns` is given.
+    """
+    statement = paginate_items(
+        select(*item_columns(columns)) if columns else select(ItemSchema),
+        filter=filter,
+        offset=offset,
+        limit=limit,
+        after=after,
+        user_id=user_id,
+    )
+    result = (await db.execute(statement)).all() if columns else (await db.scalars(statement)).all()
+    logger.debug(f"get_items() -> {result}")
+    return result
+
+
+async def get_items_versions(
+    db: AsyncSession,
+    filter: str,
+    offset: int,
+    limit: int,
+    after: Cursor | None = None,
+    user_id: UUID | None = None,
+) -> Sequence[Row[tuple[UUID, datetime]]]:
+    """
+    Repository layer function to retreive only the `(id, updated_on)` pairs of the items returned by :func:`get_items`.
+
+    Args:
+        db: The :class:`AsyncSession` to connect to the database.
+        filter: a string to emit a filter on the database query.
+        offset: an int to emit an offset on the database query. Ignored when `after` is given.
+        limit: an int to emit a limit on the database query.
+        after: the keyset `(created_on, id)` of the last item of the previous page for keyset pagination.
+        user_id: if given, only the items of this user are returned.
+
+    Returns:
+        A sequence of `(id, updated_on)` rows.
+    """
+    statement = paginate_items(
+        select(ItemSchema.id, ItemSchema.updated_on),
+        filter=filter,
+        offset=offset,
+        limit=limit,
+        after=after,
+        user_id=user_id,
+    )
+    result = (await db.execute(statement)).all()
+    logger.debug(f"get_items_versions() -> {len(result)} rows")
+    return result
+
+
+async def stream_items(db: AsyncSession, filter: str) -> AsyncIterator[Sequence[Row]]:
+    """
+    Repository layer function to read the items through a server side cursor, `EXPORT_CHUNK_SIZE` rows at a time.
+    Plain rows are fetched instead of :class:`ItemSchema` instances so that nothing piles up in the session.
+
+    Args:
+        db: The :class:`AsyncSession` to connect to the database.
+        filter: a string to emit a filter on the database query.
+
+    Yields:
+        Chunks of rows with the columns of the items table.
+    """
+    statement = select(*ItemSchema.__table__.columns).order_by(ItemSchema.created_on, ItemSchema.id)
+    if filter:
+        statement = statement.where(ItemSchema.name.contains(filter))
+    result = await db.stream(statement.execution_options(yield_per=get_settings().EXPORT_CHUNK_SIZE))
+    async for partition in result.partitions():
+        yield partition
+
+
+async def search_items(db: AsyncSession, query: str, limit: int, ranked: bool = False) -> Sequence[ItemSchema]:
+    """
+    Repository layer function to search items by a case insensitive substring of their name.
+    The `ILIKE` filter is served by the `ix_items_name_trgm` trigram index for queries of 3 characters or more.
+
+    Args:
+        db: The :class:`AsyncSession` to connect to the database.
+        query: the substring to look for in the item names.
+        limit: an int to emit a limit on the database query.
+        ranked: if True, the items are ordered by trigram similarity with the query, best matches first.
 
     Returns:
         A sequence of :class:`ItemSchema`.
     """
-    statement = select(ItemSchema).where(ItemSchema.name.contains(filter)).offset(offset).limit(limit)
+    statement = select(ItemSchema).where(ItemSchema.name.icontains(query, autoescape=True)).limit(limit)
+    if ranked:
+        statement = statement.order_by(func.similarity(ItemSchema.name, query).desc(), ItemSchema.id)
+    else:
+        statement = statement.order_by(ItemSchema.created_on, ItemSchema.id)
     result = (await db.scalars(statement)).all()
-    logger.debug(f"get_items() -> {result}")
+    logger.debug(f"search_items({query}, ranked={ranked}) -> {result}")
     return result
 
 
-async def get_items_count(db: AsyncSession) -> int:
+async def get_items_count(db: AsyncSession, exact: bool = True) -> int:
     """
     Repository layer function to get the number of items stored in the database.
 
     Args:
         db: The :class:`AsyncSession` to connect to the database.
+        exact: if False, returns the planner's estimate instead of counting the rows. Falls back to an exact count when no estimate is available.
 
     Returns:
         The number of items stored in the database as an integer.
     """
+    if not exact:
+        estimate = await get_estimated_count(db, ItemSchema.__tablename__)
+        if estimate is not None:
+            logger.debug(f"get_items_count(exact=False) -> {estimate}")
+            return estimate
     statement = select(func.count()).select_from(ItemSchema)
     result = await db.scalar(statement)
     logger.debug(f"get_items_count() -> {result}")
     return result if result else 0
 
 
-async def get_item_by_uuid(uuid: UUID, db: AsyncSession) -> ItemSchema | None:
+async def get_item_by_uuid(
+    uuid: UUID, db: AsyncSession, columns: list[str] | None = None
+) -> ItemSchema | Row | None:
     """
     Repository layer function to query a item by his primary key.
 
     Args:
         uuid: the uuid variable to make the query
         db: The :class:`AsyncSession` to connect to the database.
+        columns: if given, only these columns are selected and a :class:`Row` is returned instead of the schema.
 
     Returns:
         The item corresponding to the uuid as a :class:`ItemSchema` instance, if present in the database, else None.
     """
-    result = await db.get(ItemSchema, uuid)
+    if columns:
+        result = (await db.execute(select(*item_columns(columns)).where(ItemSchema.id == uuid))).first()
+    else:
+        result = await db.get(ItemSchema, uuid)
     logger.debug(f"get_listing_by_uuid({uuid}) -> {result}")
     return result
 
 
+async def get_item_updated_on(uuid: UUID, db: AsyncSession) -> datetime | None:
+    """
+    Repository layer function to query only the last update date of an item.
+
+    Args:
+        uuid: the uuid variable to make the query
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Returns:
+        The `updated_on` column of the item, if present in the database, else None.
+    """
+    result = await db.scalar(ITEM_UPDATED_ON, {"uuid": uuid})
+    logger.debug(f"get_item_updated_on({uuid}) -> {result}")
+    return result
+
+
 async def create_item(item: CreateItemModel, db: AsyncSession) -> ItemSchema:
     """
     Repository layer function to add a new item to the database
@@ -80,6 +256,34 @@ async def create_item(item: CreateItemModel, db: AsyncSession) -> ItemSchema:
     return schema
 
 
+async def create_items(
+    items: list[CreateItemModel],
+    db: AsyncSession,
+    returning: type[ItemSchema] | InstrumentedAttribute[UUID] = ItemSchema,
+) -> list[ItemSchema] | list[UUID]:
+    """
+    Repository layer function to add several items to the database with one multi-row `INSERT ... RETURNING` per chunk
+    of `BULK_INSERT_CHUNK_SIZE` items, capped so that a chunk never binds more than `MAX_BIND_PARAMETERS` values.
+
+    Args:
+        items: The list of :class:`CreateItemModel` instances to add to the database.
+        db: The :class:`AsyncSession` to connect to the database.
+        returning: what to return for each item: the :class:`ItemSchema` by default, or `ItemSchema.id` for its id only.
+
+    Return:
+        a list of :class:`ItemSchema` instances or of uuid primary keys corresponding to the items added to the
+        database, in the same order.
+    """
+    chunk_size = min(get_settings().BULK_INSERT_CHUNK_SIZE, MAX_BIND_PARAMETERS // len(CreateItemModel.model_fields))
+    result: list = []
+    for start in range(0, len(items), chunk_size):
+        values = [item.model_dump() for item in items[start : start + chunk_size]]
+        statement = insert(ItemSchema).values(values).returning(returning)
+        result.extend((await db.scalars(statement)).all())
+    logger.debug(f"create_items({len(items)} items, returning={returning}) -> {len(result)} created")
+    return result
+
+
 async def update_item(item: UpdateItemModel, db: AsyncSession) -> ItemSchema | None:
     """
     Repository layer function to update an item from the database
@@ -91,12 +295,13 @@ async def update_item(item: UpdateItemModel, db: AsyncSession) -> ItemSchema | N
     Return:
         a :class:`ItemSchema` instance corresponding to the item updated to the database or None if the item was not found.
     """
-    schema: ItemSchema | None = await db.get(ItemSchema, item.id)
-    if schema is None:
-        return None
-    schema.update_from_model(item)
-    await db.flush()
-    await db.refresh(schema)
+    statement = (
+        update(ItemSchema)
+        .where(ItemSchema.id == item.id)
+        .values(**item.model_dump(exclude={"id"}), updated_on=func.now())
+        .returning(ItemSchema)
+    )
+    schema: ItemSchema | None = await db.scalar(statement)
     logger.debug(f"update_item({item!r}) -> {schema}")
     return schema
 
@@ -112,9 +317,40 @@ async def delete_item_by_uuid(uuid: UUID, db: AsyncSession) -> bool:
     Return:
         a `bool` to indicate the success or failure of the operation.
     """
-    schema: ItemSchema | None = await db.get(ItemSchema, uuid)
-    logger.debug(f"delete_item_by_uuid({uuid}) -> {schema}")
-    if schema is None:
-        return False
-    await db.delete(schema)
-    return True
+    statement = delete(ItemSchema).where(ItemSchema.id == uuid).returning(ItemSchema.id)
+    result = await db.scalar(statement)
+    logger.debug(f"delete_item_by_uuid({uuid}) -> {result}")
+    return result is not None
+
+
+async def delete_items_by_uuids(uuids: list[UUID], db: AsyncSession) -> list[UUID]:
+    """
+    Repository layer function to delete several items from the database with a single `DELETE ... WHERE id = ANY(:ids)`.
+
+    Args:
+        uuids: the uuid primary keys of the items to delete.
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Return:
+        the list of the uuids of the items that were deleted.
+    """
+    ids = bindparam("ids", uuids, type_=ARRAY(Uuid))
+    statement = delete(ItemSchema).where(ItemSchema.id == any_(ids)).returning(ItemSchema.id)
+    result = list((await db.scalars(statement)).all())
+    logger.debug(f"delete_items_by_uuids({len(uuids)} uuids) -> {len(result)} deleted")
+    return result
+
+
+async def warm_up(db: AsyncSession) -> None:
+    """
+    Runs the statements of the item reads once, with their default options, so that they are compiled and prepared
+    before the first requests. See :mod:`app.core.warmup`.
+
+    Args:
+        db: The :class:`AsyncSession` to connect to the database.
+    """
+    await get_items(db, filter="", offset=0, limit=1)
+    await get_items_versions(db, filter="", offset=0, limit=1)
+    await get_items_count(db)
+    await get_item_by_uuid(uuid4(), db)
+    await get_item_updated_on(uuid4(), db)
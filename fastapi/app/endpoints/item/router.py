@@ -1,54 +1,148 @@
 from typing import Annotated
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, Query, Security, HTTPException, Path
+from fastapi import APIRouter, Body, Depends, Header, Query, Security, HTTPException, Path, Response
+from fastapi.responses import StreamingResponse
 
-from app.core.database import AsyncSession, get_db
+from app.core.config import get_settings
+from app.core.database import AsyncSession, ReadSessionRoute, get_db, get_read_db
+from app.core.deadline import route_timeout
+from app.core.pagination import MAX_PAGE_SIZE, NEXT_CURSOR_HEADER, encode_cursor, decode_cursor
+from app.core.etag import make_etag, etag_matches, not_modified
+from app.core.projection import parse_fields, output_fields
 import app.endpoints.user.security as security
-from app.endpoints.item.util import ResponseItemModel, CreateItemModel, UpdateItemModel
+from app.endpoints.item.util import (
+    ResponseItemModel,
+    CreateItemModel,
+    UpdateItemModel,
+    ExportFormat,
+    response_items_adapter,
+)
 import app.endpoints.item.service as service
 
-router = APIRouter(prefix="/item", tags=["Items"])
+router = APIRouter(prefix="/item", tags=["Items"], route_class=ReadSessionRoute)
+settings = get_settings()
 
 
 @router.get(
     "",
     response_model=list[ResponseItemModel],
-    dependencies=[Security(security.verify_jwt, scopes=["items:view"])],
-    description="Get the items stored in the database",
+    dependencies=[
+        Depends(route_timeout(settings.ITEMS_SEARCH_TIMEOUT)),
+        Security(security.verify_jwt, scopes=["items:view"]),
+    ],
+    description="Get the items stored in the database. "
+    "Use `fields` to only get some of the fields, the id is always returned. "
+    f"When the page is full, the `{NEXT_CURSOR_HEADER}` header holds the cursor of the next page. "
+    "Answers `304 Not Modified` when the `If-None-Match` header matches the ETag of the page.",
 )
 async def get_items(
-    db: Annotated[AsyncSession, Depends(get_db)],
+    db: Annotated[AsyncSession, Depends(get_read_db)],
     filter: Annotated[str, Query(title="Champ de recherche")] = "",
-    offset: Annotated[int, Query(title="Offset pour la pagination")] = 0,
-    limit: Annotated[int, Query(title="Taille de la page : 100 par défaut")] = 100,
-) -> list[ResponseItemModel]:
-    return await service.get_items(db=db, filter=filter, offset=offset, limit=limit)
+    offset: Annotated[int, Query(title="Offset pour la pagination", ge=0)] = 0,
+    limit: Annotated[int, Query(title="Taille de la page : 100 par défaut", ge=1, le=MAX_PAGE_SIZE)] = 100,
+    cursor: Annotated[str | None, Query(title="Curseur de la page suivante, remplace l'offset")] = None,
+    user_id: Annotated[UUID | None, Query(title="Ne retourner que les items de cet utilisateur")] = None,
+    fields: Annotated[str | None, Query(title="Champs à retourner, séparés par des virgules")] = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> Response:
+    try:
+        after = decode_cursor(cursor) if cursor else None
+        projection = parse_fields(fields, ResponseItemModel)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if if_none_match:
+        etag = await service.get_items_etag(
+            db=db, filter=filter, offset=offset, limit=limit, after=after, user_id=user_id
+        )
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+    result = await service.get_items(
+        db=db, filter=filter, offset=offset, limit=limit, after=after, user_id=user_id, fields=projection
+    )
+    headers = {"ETag": make_etag(version for item in result for version in item.get_versions())}
+    if result and len(result) == limit:
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(result[-1].created_on, result[-1].id)
+    # Already validated by the service: skip the response_model validation and dump the JSON bytes directly
+    include = {"__all__": output_fields(projection)} if projection else None
+    content = response_items_adapter.dump_json(result, include=include)
+    return Response(content=content, media_type="application/json", headers=headers)
 
 
 @router.get(
     "/count",
     response_model=int,
     dependencies=[Security(security.verify_jwt, scopes=["items:view"])],
-    description="Get the number of items stored in the database",
+    description="Get the number of items stored in the database. Use `exact=false` for a cheap estimate",
 )
-async def get_items_count(db: Annotated[AsyncSession, Depends(get_db)]) -> int:
-    return await service.get_items_count(db)
+async def get_items_count(
+    db: Annotated[AsyncSession, Depends(get_read_db)],
+    exact: Annotated[bool, Query(title="Compte exact, sinon estimation du planificateur")] = True,
+) -> int:
+    return await service.get_items_count(db, exact=exact)
+
+
+@router.get(
+    "/search",
+    response_model=list[ResponseItemModel],
+    dependencies=[Security(security.verify_jwt, scopes=["items:view"])],
+    description="Search the items by name (case insensitive). Use `ranked` to get the closest matches first",
+)
+async def search_items(
+    db: Annotated[AsyncSession, Depends(get_read_db)],
+    q: Annotated[str, Query(title="Texte à rechercher dans le nom", min_length=1)],
+    ranked: Annotated[bool, Query(title="Trier par pertinence")] = False,
+    limit: Annotated[int, Query(title="Nombre de résultats : 100 par défaut", ge=1, le=MAX_PAGE_SIZE)] = 100,
+) -> Response:
+    result = await service.search_items(db=db, query=q, limit=limit, ranked=ranked)
+    return Response(content=response_items_adapter.dump_json(result), media_type="application/json")
+
+
+@router.get(
+    "/export",
+    response_class=StreamingResponse,
+    dependencies=[Security(security.verify_jwt, scopes=["items:view"])],
+    description="Export all the items stored in the database as a NDJSON or CSV stream",
+)
+async def export_items(
+    filter: Annotated[str, Query(title="Champ de recherche")] = "",
+    format: Annotated[ExportFormat, Query(title="Format de l'export")] = ExportFormat.ndjson,
+) -> StreamingResponse:
+    media_type = "text/csv" if format is ExportFormat.csv else "application/x-ndjson"
+    return StreamingResponse(
+        service.export_items(filter=filter, format=format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="items.{format.value}"'},
+    )
 
 
 @router.get(
     "/{uuid}",
     response_model=ResponseItemModel,
     dependencies=[Security(security.verify_jwt, scopes=["items:view"])],
-    description="Get an item by uuid (primary key) stored in the database",
+    description="Get an item by uuid (primary key) stored in the database. "
+    "Use `fields` to only get some of the fields, the id is always returned. "
+    "Answers `304 Not Modified` when the `If-None-Match` header matches the ETag of the item.",
 )
 async def get_item_by_uuid(
-    uuid: Annotated[UUID, Path(title="uuid to query the listing")], db: Annotated[AsyncSession, Depends(get_db)]
-) -> ResponseItemModel:
-    result = await service.get_item_by_uuid(uuid, db=db)
+    uuid: Annotated[UUID, Path(title="uuid to query the listing")],
+    db: Annotated[AsyncSession, Depends(get_read_db)],
+    fields: Annotated[str | None, Query(title="Champs à retourner, séparés par des virgules")] = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> Response:
+    try:
+        projection = parse_fields(fields, ResponseItemModel)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if if_none_match:
+        etag = await service.get_item_etag(uuid, db=db)
+        if etag is not None and etag_matches(if_none_match, etag):
+            return not_modified(etag)
+    result = await service.get_item_json_by_uuid(uuid, db=db, fields=projection)
     if result is None:
         raise HTTPException(status_code=404, detail="Item not found")
-    return result
+    etag, content = result
+    return Response(content=content, media_type="application/json", headers={"ETag": etag})
 
 
 @router.post(
@@ -62,6 +156,24 @@ async def add_item(item: CreateItemModel, db: Annotated[AsyncSession, Depends(ge
     return await service.create_item(item=item, db=db)
 
 
+@router.post(
+    "/bulk",
+    response_model=list[ResponseItemModel] | list[UUID],
+    dependencies=[Security(security.verify_jwt, scopes=["items:edit"])],
+    status_code=201,
+    description="Create several items at once. Use `minimal` to only get back the ids of the created items",
+)
+async def add_items(
+    items: list[CreateItemModel],
+    db: Annotated[AsyncSession, Depends(get_db)],
+    minimal: Annotated[bool, Query(title="Ne retourner que les ids")] = False,
+) -> list[UUID] | Response:
+    if minimal:
+        return await service.create_items_returning_ids(items=items, db=db)
+    result = await service.create_items(items=items, db=db)
+    return Response(content=response_items_adapter.dump_json(result), media_type="application/json", status_code=201)
+
+
 @router.put(
     "",
     response_model=ResponseItemModel,
@@ -76,6 +188,19 @@ async def update_item(item: UpdateItemModel, db: Annotated[AsyncSession, Depends
     return result
 
 
+@router.delete(
+    "",
+    response_model=list[UUID],
+    dependencies=[Security(security.verify_jwt, scopes=["items:edit"])],
+    description="Delete several items by their uuid primary keys. Returns the uuids of the deleted items",
+)
+async def delete_items_by_uuids(
+    uuids: Annotated[list[UUID], Body(title="uuids of the items to delete")],
+    db: Annotated[AsyncSession, Depends(get_db)],
+) -> list[UUID]:
+    return await service.delete_items_by_uuids(uuids=uuids, db=db)
+
+
 @router.delete(
     "/{uuid}",
     status_code=204,
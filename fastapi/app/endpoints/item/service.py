@@ -1,55 +1,236 @@
+import csv
+from datetime import datetime
+from io import StringIO
+from typing import AsyncIterator
 from uuid import UUID
-from app.core.database import AsyncSession
+from app.core.database import AsyncSession, on_commit, read_session
+from app.core.cache import count_cache, item_cache
+from app.core.pagination import Cursor
+from app.core.etag import make_etag
+from app.core.projection import selected_fields, output_fields, projection_model, projection_adapter
 
-from app.endpoints.item.util import ResponseItemModel, ItemSchema, CreateItemModel, UpdateItemModel
+from app.endpoints.item.util import (
+    ResponseItemModel,
+    ItemSchema,
+    CreateItemModel,
+    UpdateItemModel,
+    ExportFormat,
+    response_items_adapter,
+)
 import app.endpoints.item.repository as repository
 
 
-async def get_items(db: AsyncSession, filter: str, offset: int, limit: int) -> list[ResponseItemModel]:
+async def get_items(
+    db: AsyncSession,
+    filter: str,
+    offset: int,
+    limit: int,
+    after: Cursor | None = None,
+    user_id: UUID | None = None,
+    fields: frozenset[str] | None = None,
+) -> list[ResponseItemModel]:
     """
     Service layer function to get the items stored in the database.
 
     Args:
         db: The :class:`AsyncSession` to connect to the database.
         filter: a string to emit a filter on the database query.
-        offset: an int to emit an offset on the database query.
+        offset: an int to emit an offset on the database query. Ignored when `after` is given.
         limit: an int to emit a limit on the database query.
+        after: the keyset of the last item of the previous page for keyset pagination.
+        user_id: if given, only the items of this user are returned.
+        fields: if given, only these fields are selected from the database, the others are left to None.
 
     Returns:
         A list of :class:`ResponseItemModel`.
     """
-    result = await repository.get_items(db, filter=filter, offset=offset, limit=limit)
-    return [ResponseItemModel.model_validate(s) for s in result]
+    result = await repository.get_items(
+        db,
+        filter=filter,
+        offset=offset,
+        limit=limit,
+        after=after,
+        user_id=user_id,
+        columns=selected_fields(fields) if fields else None,
+    )
+    adapter = projection_adapter(ResponseItemModel, fields) if fields else response_items_adapter
+    return adapter.validate_python(result, from_attributes=True)
 
 
-async def get_items_count(db: AsyncSession) -> int:
+async def export_items(filter: str, format: ExportFormat) -> AsyncIterator[str]:
+    """
+    Service layer function to export the items stored in the database chunk by chunk, to be sent in a streaming response.
+    It opens its own session, on the read replica if any, so that the connection is held for as long as the export
+    is being streamed.
+
+    Args:
+        filter: a string to emit a filter on the database query.
+        format: the :class:`ExportFormat` of the export.
+
+    Yields:
+        The export as `str` chunks, one line per item.
+    """
+    columns = list(ResponseItemModel.model_fields)
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    if format is ExportFormat.csv:
+        writer.writerow(columns)
+    async with await read_session() as db:
+        async for rows in repository.stream_items(db, filter=filter):
+            if format is ExportFormat.csv:
+                for row in rows:
+                    writer.writerow(
+                        value.isoformat() if isinstance(value, datetime) else value
+                        for value in (getattr(row, column) for column in columns)
+                    )
+            else:
+                for row in rows:
+                    buffer.write(ResponseItemModel.model_validate(row).model_dump_json())
+                    buffer.write("\n")
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+async def get_items_etag(
+    db: AsyncSession,
+    filter: str,
+    offset: int,
+    limit: int,
+    after: Cursor | None = None,
+    user_id: UUID | None = None,
+) -> str:
+    """
+    Service layer function to get the ETag of a page of :func:`get_items` without loading the items.
+
+    Args:
+        db: The :class:`AsyncSession` to connect to the database.
+        filter: a string to emit a filter on the database query.
+        offset: an int to emit an offset on the database query. Ignored when `after` is given.
+        limit: an int to emit a limit on the database query.
+        after: the keyset of the last item of the previous page for keyset pagination.
+        user_id: if given, only the items of this user are returned.
+
+    Returns:
+        The ETag of the page as a `str`.
+    """
+    result = await repository.get_items_versions(
+        db, filter=filter, offset=offset, limit=limit, after=after, user_id=user_id
+    )
+    return make_etag((row.id, row.updated_on) for row in result)
+
+
+async def search_items(db: AsyncSession, query: str, limit: int, ranked: bool = False) -> list[ResponseItemModel]:
+    """
+    Service layer function to search the items by name.
+
+    Args:
+        db: The :class:`AsyncSession` to connect to the database.
+        query: the substring to look for in the item names.
+        limit: an int to emit a limit on the database query.
+        ranked: if True, the best matches are returned first.
+
+    Returns:
+        A list of :class:`ResponseItemModel`.
+    """
+    result = await repository.search_items(db, query=query, limit=limit, ranked=ranked)
+    return response_items_adapter.validate_python(result, from_attributes=True)
+
+
+async def get_items_count(db: AsyncSession, exact: bool = True) -> int:
     """
     Service layer function to get the number of items stored in the database.
+    The exact count is cached for `COUNT_CACHE_TTL` seconds and invalidated when an item is created or deleted.
 
     Args:
         db: The :class:`AsyncSession` to connect to the database.
+        exact: if False, returns the planner's estimate instead of counting the rows.
 
     Returns:
         The number of items stored in the database as an integer.
     """
-    return await repository.get_items_count(db)
+    if not exact:
+        return await repository.get_items_count(db, exact=False)
+    result = count_cache.get(ItemSchema.__tablename__)
+    if result is None:
+        result = await repository.get_items_count(db)
+        count_cache.set(ItemSchema.__tablename__, result)
+    return result
 
 
-async def get_item_by_uuid(uuid: UUID, db: AsyncSession) -> ResponseItemModel | None:
+async def get_item_by_uuid(
+    uuid: UUID, db: AsyncSession, fields: frozenset[str] | None = None
+) -> ResponseItemModel | None:
     """
     Service layer function to query an item by his uuid primary key.
 
     Args:
         uuid: the uuid primary key variable to make the query
         db: The :class:`AsyncSession` to connect to the database.
+        fields: if given, only these fields are selected from the database, the others are left to None.
 
     Returns:
         The item corresponding to the uuid as a :class:`ResponseItemModel` instance, if present in the database, else None.
     """
+    if fields:
+        result = await repository.get_item_by_uuid(uuid, db, columns=selected_fields(fields))
+        return projection_model(ResponseItemModel, fields).model_validate(result) if result else None
     result = await repository.get_item_by_uuid(uuid, db)
     return ResponseItemModel.model_validate(result) if result else None
 
 
+async def get_item_json_by_uuid(
+    uuid: UUID, db: AsyncSession, fields: frozenset[str] | None = None
+) -> tuple[str, str] | None:
+    """
+    Service layer function to get the serialized :class:`ResponseItemModel` of an item by his uuid primary key.
+    The full item is read through the `item_cache`, so cache hits skip both the database and the validation.
+    The items read from the replica are not cached: it may not have replayed the update that just invalidated them.
+
+    Args:
+        uuid: the uuid primary key variable to make the query
+        db: The :class:`AsyncSession` to connect to the database.
+        fields: if given, only these fields are selected and serialized. The cache is bypassed.
+
+    Returns:
+        The ETag and the JSON of the item corresponding to the uuid as `str`, if present in the database, else None.
+    """
+    if fields:
+        item = await get_item_by_uuid(uuid, db, fields=fields)
+        if item is None:
+            return None
+        return make_etag(item.get_versions()), item.model_dump_json(include=output_fields(fields))
+    result = item_cache.get(uuid)
+    if result is None:
+        item = await get_item_by_uuid(uuid, db)
+        if item is None:
+            return None
+        result = make_etag(item.get_versions()), item.model_dump_json()
+        if not db.info.get("replica"):
+            item_cache.set(uuid, result)
+    return result
+
+
+async def get_item_etag(uuid: UUID, db: AsyncSession) -> str | None:
+    """
+    Service layer function to get the ETag of an item without loading it. A cached item is trusted like in :func:`get_item_json_by_uuid`.
+
+    Args:
+        uuid: the uuid primary key variable to make the query
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Returns:
+        The ETag of the item as a `str`, if present in the database, else None.
+    """
+    cached = item_cache.get(uuid)
+    if cached is not None:
+        return cached[0]
+    updated_on = await repository.get_item_updated_on(uuid, db)
+    return make_etag([(uuid, updated_on)]) if updated_on else None
+
+
 async def create_item(item: CreateItemModel, db: AsyncSession) -> ResponseItemModel:
     """
     Service layer function to create an item to the database.
@@ -62,9 +243,42 @@ async def create_item(item: CreateItemModel, db: AsyncSession) -> ResponseItemMo
         a :class:`ResponseItemModel` instance corresponding to the item added to the database.
     """
     result: ItemSchema = await repository.create_item(item, db)
+    on_commit(db, count_cache.invalidate, ItemSchema.__tablename__)
     return ResponseItemModel.model_validate(result)
 
 
+async def create_items(items: list[CreateItemModel], db: AsyncSession) -> list[ResponseItemModel]:
+    """
+    Service layer function to create several items in the database.
+
+    Args:
+        items: The list of :class:`CreateItemModel` instances to add to the database.
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Return:
+        a list of :class:`ResponseItemModel` instances corresponding to the items added to the database.
+    """
+    result = await repository.create_items(items, db)
+    on_commit(db, count_cache.invalidate, ItemSchema.__tablename__)
+    return response_items_adapter.validate_python(result, from_attributes=True)
+
+
+async def create_items_returning_ids(items: list[CreateItemModel], db: AsyncSession) -> list[UUID]:
+    """
+    Service layer function to create several items in the database, only returning their ids.
+
+    Args:
+        items: The list of :class:`CreateItemModel` instances to add to the database.
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Return:
+        a list of the uuid primary keys of the items added to the database.
+    """
+    result = await repository.create_items(items, db, returning=ItemSchema.id)
+    on_commit(db, count_cache.invalidate, ItemSchema.__tablename__)
+    return result
+
+
 async def update_item(item: UpdateItemModel, db: AsyncSession) -> ResponseItemModel | None:
     """
     Service layer function to update an item from the database.
@@ -77,6 +291,7 @@ async def update_item(item: UpdateItemModel, db: AsyncSession) -> ResponseItemMo
         a :class:`ResponseItemModel` instance corresponding to the item updated in the database or None if the item was not found.
     """
     result = await repository.update_item(item=item, db=db)
+    on_commit(db, item_cache.invalidate, item.id)
     return ResponseItemModel.model_validate(result) if result else None
 
 
@@ -91,4 +306,26 @@ async def delete_item_by_uuid(uuid: UUID, db: AsyncSession) -> bool:
     Return:
         a `bool` to indicate the success or failure of the operation.
     """
-    return await repository.delete_item_by_uuid(uuid=uuid, db=db)
+    result = await repository.delete_item_by_uuid(uuid=uuid, db=db)
+    if result:
+        on_commit(db, count_cache.invalidate, ItemSchema.__tablename__)
+        on_commit(db, item_cache.invalidate, uuid)
+    return result
+
+
+async def delete_items_by_uuids(uuids: list[UUID], db: AsyncSession) -> list[UUID]:
+    """
+    Service layer function to delete several items from the database.
+
+    Args:
+        uuids: the uuid primary keys of the items to delete.
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Return:
+        the list of the uuids of the items that were deleted.
+    """
+    result = await repository.delete_items_by_uuids(uuids=uuids, db=db)
+    if result:
+        on_commit(db, count_cache.invalidate, ItemSchema.__tablename__)
+        on_commit(db, item_cache.invalidate, *result)
+    return result
@@ -1,11 +1,18 @@
 from datetime import datetime
+from enum import Enum
 from uuid import UUID
 
-from pydantic import BaseModel, ConfigDict, PastDatetime
-from sqlalchemy import ForeignKey, func
+from pydantic import BaseModel, ConfigDict, PastDatetime, TypeAdapter
+from sqlalchemy import ForeignKey, Index, func
 from sqlalchemy.orm import Mapped, mapped_column
 
 from app.core.database import Base
+from app.core.etag import Version
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
 
 
 class ListingModel(BaseModel):
@@ -39,11 +46,23 @@ class ResponseItemModel(ListingModel):
     updated_on: PastDatetime
     user_id: UUID
 
+    def get_versions(self) -> list[Version]:
+        return [(self.id, self.updated_on)]
+
+
+# Validates and serializes a whole list in one call, see the list endpoints of the router
+response_items_adapter: TypeAdapter[list[ResponseItemModel]] = TypeAdapter(list[ResponseItemModel])
+
 
 class ItemSchema(Base):
     """Schema mirroring the items table in the database"""
 
     __tablename__ = "items"
+    __table_args__ = (
+        Index("ix_items_created_on_id", "created_on", "id"),
+        Index("ix_items_name_trgm", "name", postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"}),
+        Index("ix_items_user_id_created_on", "user_id", "created_on"),
+    )
 
     id: Mapped[UUID] = mapped_column(init=False, primary_key=True, server_default=func.uuid_generate_v4())
     name: Mapped[str] = mapped_column(nullable=False)
@@ -52,8 +71,3 @@ class ItemSchema(Base):
     updated_on: Mapped[datetime] = mapped_column(
         init=False, nullable=False, onupdate=func.now(), server_default=func.now()
     )
-
-    def update_from_model(self, model: UpdateItemModel) -> None:
-        for field, value in model.model_dump().items():
-            if hasattr(self, field) and value is not None:
-                setattr(self, field, value)
@@ -0,0 +1,91 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from uuid import UUID
+
+from app.core.config import get_settings
+from app.core.database import async_session
+from app.core.logger import logger_factory
+import app.endpoints.user.repository as repository
+
+logger = logger_factory(__name__)
+settings = get_settings()
+
+# Epoch of the deleted and disabled users, that no token matches
+REVOKED = -1
+
+
+class EpochTable:
+    """
+    In-memory copy of the token epochs of the users, to check the stateless tokens without querying the database.
+    A token is valid while it carries the current epoch of its user. Only the users whose tokens were revoked are
+    stored, the others are at epoch 0. The updates and deletes of the users change the epoch of the local table once
+    committed, and the table is reloaded every `TOKEN_EPOCH_RELOAD_INTERVAL` seconds to see the writes of the other
+    instances. The reloads also forget the deleted users whose tokens have expired.
+    """
+
+    def __init__(self) -> None:
+        self.loaded_on: datetime | None = None
+        self._epochs: dict[UUID, int] = {}
+        # epochs changed locally while a reload is running, that its snapshot may not see
+        self._pending: dict[UUID, int] | None = None
+        self._task: asyncio.Task | None = None
+
+    def get(self, uuid: UUID) -> int:
+        """Returns the current epoch of the user, :data:`REVOKED` if he was deleted or disabled."""
+        return self._epochs.get(uuid, 0)
+
+    def set(self, uuid: UUID, epoch: int) -> None:
+        """Stores the new epoch of the user, revoking the tokens issued before."""
+        self._epochs[uuid] = epoch
+        if self._pending is not None:
+            self._pending[uuid] = epoch
+
+    def revoke(self, *uuids: UUID) -> None:
+        """Revokes all the tokens of the users."""
+        for uuid in uuids:
+            self.set(uuid, REVOKED)
+
+    async def reload(self) -> None:
+        """
+        Replaces the table with the epochs stored in the database. The epochs changed locally during the reload are
+        kept over the ones of the snapshot, which may have been read before their commit.
+        """
+        loaded_on = datetime.now(timezone.utc)
+        expired_on = loaded_on - timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
+        self._pending = {}
+        try:
+            async with async_session() as db:
+                await repository.delete_revoked_users(expired_on, db)
+                rows = await repository.get_token_epochs(db)
+                await db.commit()
+            epochs = {row.id: REVOKED if row.is_disabled else row.token_epoch for row in rows}
+            self._epochs = epochs | self._pending
+        finally:
+            self._pending = None
+        self.loaded_on = loaded_on
+
+    async def _reload_forever(self) -> None:
+        while True:
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error(f"Failed to reload the token epochs: {e!r}")
+            await asyncio.sleep(settings.TOKEN_EPOCH_RELOAD_INTERVAL)
+
+    def start(self) -> None:
+        """Starts reloading the table in the background."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._reload_forever())
+
+    async def stop(self) -> None:
+        """Stops reloading the table."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+epoch_table = EpochTable()
@@ -1,51 +1,209 @@
+from datetime import datetime
 from typing import Sequence
-from uuid import UUID
+from uuid import UUID, uuid4
 
-from sqlalchemy import func
-from sqlalchemy import select
+from sqlalchemy import Row, Select, func, literal, true, union_all
+from sqlalchemy import select, update, delete, any_, bindparam, exists, or_, tuple_, Uuid
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.orm import defer, raiseload, selectinload
 
-from app.core.database import AsyncSession
+from app.core.database import AsyncSession, get_estimated_count
 from app.core.logger import logger_factory
-from app.endpoints.user.util import UserSchema, CreateUserModel, UpdateUserModel
+from app.core.pagination import Cursor
+from app.endpoints.item.util import ItemSchema
+from app.endpoints.user.util import (
+    UserSchema,
+    RevokedUserSchema,
+    CreateUserModel,
+    UpdateUserModel,
+    ImportUserModel,
+    users_import_table,
+)
 
 logger = logger_factory(__name__)
 
+# Fields whose update revokes the tokens issued before, see app.endpoints.user.epochs
+TOKEN_FIELDS = {"password", "role", "is_disabled"}
 
-async def get_users(db: AsyncSession) -> Sequence[UserSchema]:
+
+def paginate_users(statement: Select, filter: str, offset: int, limit: int, after: Cursor | None = None) -> Select:
+    """
+    Applies the filter and the pagination of the users listing to a statement selecting from the users table.
+
+    Args:
+        statement: the :class:`Select` statement to paginate.
+        filter: a string to emit a filter on the name or the email of the users.
+        offset: an int to emit an offset on the database query. Ignored when `after` is given.
+        limit: an int to emit a limit on the database query.
+        after: the keyset `(created_on, id)` of the last user of the previous page for keyset pagination.
+
+    Returns:
+        The statement ordered by `(created_on, id)`, filtered and limited.
+    """
+    statement = statement.order_by(UserSchema.created_on, UserSchema.id).limit(limit)
+    if filter:
+        statement = statement.where(or_(UserSchema.name.contains(filter), UserSchema.email.contains(filter)))
+    if after is not None:
+        statement = statement.where(tuple_(UserSchema.created_on, UserSchema.id) > after)
+    else:
+        statement = statement.offset(offset)
+    return statement
+
+
+def select_users(include_items: bool = False, columns: list[str] | None = None) -> Select:
+    """
+    Creates the statement selecting users for the read endpoints. The password hash is never loaded.
+
+    Args:
+        include_items: if True, the items of the users are loaded with a second `SELECT ... WHERE user_id IN (...)`.
+            Else the relationship is not loaded at all. Ignored when `columns` is given.
+        columns: if given, only these columns are selected, as rows instead of :class:`UserSchema`.
+
+    Returns:
+        The :class:`Select` statement.
+    """
+    if columns:
+        return select(*[UserSchema.__table__.c[name] for name in columns])
+    loader = selectinload(UserSchema.items) if include_items else raiseload(UserSchema.items)
+    return select(UserSchema).options(defer(UserSchema.password, raiseload=True), loader)
+
+
+# Statements of the hot paths, built once: their cache key is memoized, so that each call only binds the parameters
+USERS_ITEMS = (
+    select(ItemSchema)
+    .where(ItemSchema.user_id == any_(bindparam("ids", type_=ARRAY(Uuid))))
+    .order_by(ItemSchema.created_on, ItemSchema.id)
+)
+USER_WITH_PASSWORD_BY_EMAIL = (
+    select(UserSchema).options(raiseload(UserSchema.items)).where(UserSchema.email == bindparam("email"))
+)
+USER_BY_EMAIL = {
+    include_items: select_users(include_items=include_items).where(UserSchema.email == bindparam("email"))
+    for include_items in (False, True)
+}
+USER_BY_UUID = {
+    include_items: select_users(include_items=include_items).where(UserSchema.id == bindparam("uuid"))
+    for include_items in (False, True)
+}
+PRINCIPAL = select(UserSchema.id, UserSchema.role, UserSchema.is_disabled, UserSchema.token_epoch).where(
+    UserSchema.id == bindparam("uuid")
+)
+USER_VERSIONS = select(UserSchema.id, UserSchema.updated_on).where(UserSchema.id == bindparam("uuid"))
+USER_AND_ITEMS_VERSIONS = union_all(
+    USER_VERSIONS, select(ItemSchema.id, ItemSchema.updated_on).where(ItemSchema.user_id == bindparam("uuid"))
+)
+
+
+async def get_users(
+    db: AsyncSession,
+    filter: str,
+    offset: int,
+    limit: int,
+    after: Cursor | None = None,
+    include_items: bool = False,
+    columns: list[str] | None = None,
+) -> Sequence[UserSchema] | Sequence[Row]:
     """
-    Repository layer function to retreive users stored in the database.
+    Repository layer function to retreive users stored in the database, ordered by `(created_on, id)`.
 
     Args:
         db: The :class:`AsyncSession` to connect to the database.
+        filter: a string to emit a filter on the name or the email of the users.
+        offset: an int to emit an offset on the database query. Ignored when `after` is given.
+        limit: an int to emit a limit on the database query.
+        after: the keyset `(created_on, id)` of the last user of the previous page for keyset pagination.
+        include_items: if True, the items of the users are loaded with a second `SELECT ... WHERE user_id IN (...)`.
+            Else the relationship is not loaded at all. Ignored when `columns` is given, see :func:`get_users_items`.
+        columns: if given, only these columns are selected and rows are returned instead of :class:`UserSchema`.
 
     Returns:
-        A sequence of :class:`UserSchema`.
+        A sequence of :class:`UserSchema`, or of :class:`Row` when `columns` is given.
     """
-    statement = select(UserSchema)
-    result = (await db.scalars(statement)).unique().all()
+    statement = select_users(include_items=include_items, columns=columns)
+    statement = paginate_users(statement, filter=filter, offset=offset, limit=limit, after=after)
+    result = (await db.execute(statement)).all() if columns else (await db.scalars(statement)).all()
     logger.debug(f"get_users() -> {result}")
     return result
 
 
-async def get_users_count(db: AsyncSession) -> int:
+async def get_users_versions(
+    db: AsyncSession,
+    filter: str,
+    offset: int,
+    limit: int,
+    after: Cursor | None = None,
+    include_items: bool = False,
+) -> Sequence[Row[tuple[UUID, datetime]]]:
+    """
+    Repository layer function to retreive only the `(id, updated_on)` pairs of the users returned by :func:`get_users`,
+    and of their items if `include_items` is True.
+
+    Args:
+        db: The :class:`AsyncSession` to connect to the database.
+        filter: a string to emit a filter on the name or the email of the users.
+        offset: an int to emit an offset on the database query. Ignored when `after` is given.
+        limit: an int to emit a limit on the database query.
+        after: the keyset `(created_on, id)` of the last user of the previous page for keyset pagination.
+        include_items: if True, the pairs of the items of the users are returned too.
+
+    Returns:
+        A sequence of `(id, updated_on)` rows.
+    """
+    page = paginate_users(
+        select(UserSchema.id, UserSchema.updated_on), filter=filter, offset=offset, limit=limit, after=after
+    ).cte()
+    statement = select(page.c.id, page.c.updated_on)
+    if include_items:
+        statement = union_all(
+            statement,
+            select(ItemSchema.id, ItemSchema.updated_on).join(page, ItemSchema.user_id == page.c.id),
+        )
+    result = (await db.execute(statement)).all()
+    logger.debug(f"get_users_versions() -> {len(result)} rows")
+    return result
+
+
+async def get_users_count(db: AsyncSession, exact: bool = True) -> int:
     """
     Repository layer function to get the number of users stored in the database.
 
     Args:
         db: The :class:`AsyncSession` to connect to the database.
+        exact: if False, returns the planner's estimate instead of counting the rows. Falls back to an exact count when no estimate is available.
 
     Returns:
         The number of users stored in the database as an integer.
     """
+    if not exact:
+        estimate = await get_estimated_count(db, UserSchema.__tablename__)
+        if estimate is not None:
+            logger.debug(f"get_users_count(exact=False) -> {estimate}")
+            return estimate
     statement = select(func.count()).select_from(UserSchema)
     result = await db.scalar(statement)
     logger.debug(f"get_users_count() -> {result}")
     return result if result else 0
 
 
-async def get_user_by_email(email: str, db: AsyncSession) -> UserSchema | None:
+async def get_users_items(user_ids: list[UUID], db: AsyncSession) -> Sequence[ItemSchema]:
+    """
+    Repository layer function to retreive the items of several users with a single `WHERE user_id = ANY(:ids)`.
+
+    Args:
+        user_ids: the uuid primary keys of the users.
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Returns:
+        A sequence of :class:`ItemSchema` ordered by `(created_on, id)`.
+    """
+    result = (await db.scalars(USERS_ITEMS, {"ids": user_ids})).all()
+    logger.debug(f"get_users_items({len(user_ids)} users) -> {len(result)} items")
+    return result
+
+
+async def get_user_with_password_by_email(email: str, db: AsyncSession) -> UserSchema | None:
     """
-    Repository layer function to query a user by his email.
+    Repository layer function to query a user by his email, with his password hash, to authenticate him.
 
     Args:
         email: the string variable to make the query
@@ -54,28 +212,148 @@ async def get_user_by_email(email: str, db: AsyncSession) -> UserSchema | None:
     Returns:
         The user correspondinge to the email as a :class:`UserSchema` instance, if present in the database, else None.
     """
-    statement = select(UserSchema).where(UserSchema.email == email)
-    result = await db.scalar(statement)
+    result = await db.scalar(USER_WITH_PASSWORD_BY_EMAIL, {"email": email})
+    logger.debug(f"get_user_with_password_by_email({email}) -> {result}")
+    return result
+
+
+async def get_user_by_email(
+    email: str, db: AsyncSession, include_items: bool = False, columns: list[str] | None = None
+) -> UserSchema | Row | None:
+    """
+    Repository layer function to query a user by his email. The password hash is not loaded.
+
+    Args:
+        email: the string variable to make the query
+        db: The :class:`AsyncSession` to connect to the database.
+        include_items: if True, the items of the user are loaded. Ignored when `columns` is given.
+        columns: if given, only these columns are selected and a :class:`Row` is returned instead of the schema.
+
+    Returns:
+        The user correspondinge to the email as a :class:`UserSchema` instance, if present in the database, else None.
+    """
+    if columns:
+        statement = select_users(columns=columns).where(UserSchema.email == email)
+        result = (await db.execute(statement)).first()
+    else:
+        result = await db.scalar(USER_BY_EMAIL[include_items], {"email": email})
     logger.debug(f"get_user_by_email({email}) -> {result}")
     return result
 
 
-async def get_user_by_uuid(uuid: UUID, db: AsyncSession) -> UserSchema | None:
+async def get_user_by_uuid(
+    uuid: UUID, db: AsyncSession, include_items: bool = True, columns: list[str] | None = None
+) -> UserSchema | Row | None:
     """
-    Repository layer function to query a user by his primary key.
+    Repository layer function to query a user by his primary key. The password hash is not loaded.
 
     Args:
         uuid: the uuid variable to make the query
         db: The :class:`AsyncSession` to connect to the database.
+        include_items: if True, the items of the user are loaded. Ignored when `columns` is given.
+        columns: if given, only these columns are selected and a :class:`Row` is returned instead of the schema.
 
     Returns:
         The user correspondinge to the uuid as a :class:`UserSchema` instance, if present in the database, else None.
     """
-    result = await db.get(UserSchema, uuid)
+    if columns:
+        statement = select_users(columns=columns).where(UserSchema.id == uuid)
+        result = (await db.execute(statement)).first()
+    else:
+        result = await db.scalar(USER_BY_UUID[include_items], {"uuid": uuid})
     logger.debug(f"get_user_by_uuid({uuid}) -> {result}")
     return result
 
 
+async def get_principal(uuid: UUID, db: AsyncSession) -> Row[tuple[UUID, str, bool, int]] | None:
+    """
+    Repository layer function to query only the columns of a user needed to authorize his requests.
+
+    Args:
+        uuid: the uuid variable to make the query
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Returns:
+        The `(id, role, is_disabled, token_epoch)` row of the user, if present in the database, else None.
+    """
+    result = (await db.execute(PRINCIPAL, {"uuid": uuid})).first()
+    logger.debug(f"get_principal({uuid}) -> {result}")
+    return result
+
+
+async def get_token_epochs(db: AsyncSession) -> Sequence[Row[tuple[UUID, int, bool]]]:
+    """
+    Repository layer function to retreive the token epochs of the users whose tokens were revoked: the users updated
+    since their creation, the disabled users and the users deleted recently, reported as disabled.
+    The other users are at epoch 0.
+
+    Args:
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Returns:
+        A sequence of `(id, token_epoch, is_disabled)` rows.
+    """
+    statement = union_all(
+        select(UserSchema.id, UserSchema.token_epoch, UserSchema.is_disabled).where(
+            or_(UserSchema.token_epoch > 0, UserSchema.is_disabled)
+        ),
+        select(RevokedUserSchema.id, literal(0), true()),
+    )
+    result = (await db.execute(statement)).all()
+    logger.debug(f"get_token_epochs() -> {len(result)} rows")
+    return result
+
+
+async def create_revoked_users(uuids: list[UUID], db: AsyncSession) -> None:
+    """
+    Repository layer function to record the deletion of users, so that the other instances revoke their tokens.
+
+    Args:
+        uuids: the uuid primary keys of the deleted users.
+        db: The :class:`AsyncSession` to connect to the database.
+    """
+    statement = pg_insert(RevokedUserSchema).values([{"id": uuid} for uuid in uuids]).on_conflict_do_nothing()
+    await db.execute(statement)
+    logger.debug(f"create_revoked_users({uuids})")
+
+
+async def delete_revoked_users(before: datetime, db: AsyncSession) -> int:
+    """
+    Repository layer function to forget the users deleted before a date, once their tokens have expired.
+
+    Args:
+        before: the `datetime` before which the users were deleted.
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Returns:
+        the number of rows deleted.
+    """
+    statement = delete(RevokedUserSchema).where(RevokedUserSchema.revoked_on < before)
+    result = await db.execute(statement)
+    logger.debug(f"delete_revoked_users({before}) -> {result.rowcount}")
+    return result.rowcount
+
+
+async def get_user_versions(
+    uuid: UUID, db: AsyncSession, include_items: bool = True
+) -> Sequence[Row[tuple[UUID, datetime]]]:
+    """
+    Repository layer function to retreive only the `(id, updated_on)` pairs of a user and of his items.
+
+    Args:
+        uuid: the uuid variable to make the query
+        db: The :class:`AsyncSession` to connect to the database.
+        include_items: if True, the pairs of the items of the user are returned too.
+
+    Returns:
+        A sequence of `(id, updated_on)` rows, empty if the user is not present in the database.
+    """
+    statement = USER_AND_ITEMS_VERSIONS if include_items else USER_VERSIONS
+    result = (await db.execute(statement, {"uuid": uuid})).all()
+    logger.debug(f"get_user_versions({uuid}) -> {len(result)} rows")
+    return result
+
+
 async def create_user(user: CreateUserModel, db: AsyncSession) -> UserSchema:
     """
     Repository layer function to add a new user to the database
@@ -95,24 +373,117 @@ async def create_user(user: CreateUserModel, db: AsyncSession) -> UserSchema:
     return schema
 
 
-async def update_user(user: UpdateUserModel, db: AsyncSession) -> UserSchema | None:
+async def create_users_import(db: AsyncSession) -> None:
+    """
+    Repository layer function to create the staging table of the users import, dropped at the end of the transaction.
+
+    Args:
+        db: The :class:`AsyncSession` to connect to the database.
+    """
+    connection = await db.connection()
+    await connection.run_sync(users_import_table.create)
+
+
+async def copy_users_import(users: list[ImportUserModel], db: AsyncSession) -> None:
+    """
+    Repository layer function to load users in the staging table of the import with the binary COPY protocol.
+
+    Args:
+        users: The list of :class:`ImportUserModel` instances with their hashed passwords.
+        db: The :class:`AsyncSession` to connect to the database.
+    """
+    connection = await db.connection()
+    raw_connection = await connection.get_raw_connection()
+    columns = [column.name for column in users_import_table.columns]
+    await raw_connection.driver_connection.copy_records_to_table(
+        users_import_table.name,
+        records=[tuple(getattr(user, column) for column in columns) for user in users],
+        columns=columns,
+    )
+    logger.debug(f"copy_users_import({len(users)} users)")
+
+
+async def get_users_import_rejects(db: AsyncSession) -> Sequence[Row[tuple[int, bool]]]:
+    """
+    Repository layer function to retreive the lines of the staging table that :func:`merge_users_import` skips:
+    the emails already present in the import on a previous line, or already registered.
+
+    Args:
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Returns:
+        A sequence of `(line, duplicate)` rows, `duplicate` being False for the emails already registered.
+    """
+    staging = users_import_table.c
+    ranked = select(
+        staging.line,
+        staging.email,
+        (func.row_number().over(partition_by=staging.email, order_by=staging.line) > 1).label("duplicate"),
+    ).subquery()
+    statement = (
+        select(ranked.c.line, ranked.c.duplicate)
+        .where(or_(ranked.c.duplicate, exists().where(UserSchema.email == ranked.c.email)))
+        .order_by(ranked.c.line)
+    )
+    result = (await db.execute(statement)).all()
+    logger.debug(f"get_users_import_rejects() -> {len(result)} rows")
+    return result
+
+
+async def merge_users_import(db: AsyncSession) -> int:
+    """
+    Repository layer function to insert the users of the staging table, keeping the first line of each email and
+    skipping the emails already registered.
+
+    Args:
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Returns:
+        The number of users created.
+    """
+    staging = users_import_table.c
+    first_lines = (
+        select(staging.email, staging.name, staging.password)
+        .distinct(staging.email)
+        .order_by(staging.email, staging.line)
+    )
+    users = UserSchema.__table__
+    inserted = (
+        pg_insert(users)
+        .from_select(["email", "name", "password"], first_lines)
+        .on_conflict_do_nothing(index_elements=[users.c.email])
+        .returning(users.c.id)
+        .cte()
+    )
+    result = await db.scalar(select(func.count()).select_from(inserted))
+    logger.debug(f"merge_users_import() -> {result} created")
+    return result
+
+
+async def update_user(user: UpdateUserModel, db: AsyncSession, include_items: bool = False) -> UserSchema | None:
     """
-    Repository layer function to update a user from the database
+    Repository layer function to update a user from the database.
+    The token epoch of the user is bumped when one of the `TOKEN_FIELDS` changes, revoking his previous tokens.
 
     Args:
         user: The :class:`UpdateUserModel` instance to update from the database.
         db: The :class:`AsyncSession` to connect to the database.
+        include_items: if True, the items of the user are loaded after the update.
 
     Return:
         a :class:`UserSchema` instance corresponding to the user updated to the database or None if the user was not found.
     """
-    schema: UserSchema | None = await db.get(UserSchema, user.id)
-    if schema is None:
-        return None
-    schema.update_from_model(user)
-    await db.flush()
-    await db.refresh(schema)
-    logger.debug(f"update_user({user!r}) -> {schema}")
+    values = user.model_dump(exclude={"id"}, exclude_none=True)
+    if values.keys() & TOKEN_FIELDS:
+        values["token_epoch"] = UserSchema.token_epoch + 1
+    statement = (
+        update(UserSchema).where(UserSchema.id == user.id).values(**values, updated_on=func.now()).returning(UserSchema)
+    )
+    schema: UserSchema | None = await db.scalar(statement)
+    if schema is not None and include_items:
+        # RETURNING does not apply the joined eager load of the relationship
+        await schema.awaitable_attrs.items
+    logger.debug(f"update_user({user!r}, include_items={include_items}) -> {schema}")
     return schema
 
 
@@ -127,9 +498,44 @@ async def delete_user_by_uuid(uuid: UUID, db: AsyncSession) -> bool:
     Return:
         a `bool` to indicate the success or failure of the operation.
     """
-    schema: UserSchema | None = await db.get(UserSchema, uuid)
-    logger.debug(f"delete_user_by_uuid({uuid}) -> {schema}")
-    if schema is None:
-        return False
-    await db.delete(schema)
-    return True
+    statement = delete(UserSchema).where(UserSchema.id == uuid).returning(UserSchema.id)
+    result = await db.scalar(statement)
+    logger.debug(f"delete_user_by_uuid({uuid}) -> {result}")
+    return result is not None
+
+
+async def delete_users_by_uuids(uuids: list[UUID], db: AsyncSession) -> list[UUID]:
+    """
+    Repository layer function to delete several users from the database with a single `DELETE ... WHERE id = ANY(:ids)`.
+
+    Args:
+        uuids: the uuid primary keys of the users to delete.
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Return:
+        the list of the uuids of the users that were deleted.
+    """
+    ids = bindparam("ids", uuids, type_=ARRAY(Uuid))
+    statement = delete(UserSchema).where(UserSchema.id == any_(ids)).returning(UserSchema.id)
+    result = list((await db.scalars(statement)).all())
+    logger.debug(f"delete_users_by_uuids({len(uuids)} uuids) -> {len(result)} deleted")
+    return result
+
+
+async def warm_up(db: AsyncSession) -> None:
+    """
+    Runs the statements of the user reads and of the authentication once, with their default options, so that they
+    are compiled and prepared before the first requests. See :mod:`app.core.warmup`.
+
+    Args:
+        db: The :class:`AsyncSession` to connect to the database.
+    """
+    await get_users(db, filter="", offset=0, limit=1)
+    await get_users_versions(db, filter="", offset=0, limit=1)
+    await get_users_count(db)
+    await get_users_items([], db)
+    await get_user_with_password_by_email("", db)
+    await get_user_by_email("", db)
+    await get_user_by_uuid(uuid4(), db, include_items=False)
+    await get_user_versions(uuid4(), db, include_items=False)
+    await get_principal(uuid4(), db)
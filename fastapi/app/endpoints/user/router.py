@@ -1,13 +1,31 @@
 from typing import Annotated
-from fastapi import APIRouter, Depends, Path, HTTPException, Security
+from fastapi import APIRouter, Body, Depends, Header, Path, HTTPException, Query, Request, Response, Security
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import EmailStr
 from uuid import UUID
 
-from app.endpoints.user.util import CreateUserModel, ResponseUserModel, UpdateUserModel
+from app.endpoints.user.util import (
+    CreateUserModel,
+    Principal,
+    ResponseUserModel,
+    ResponseUserSummaryModel,
+    UpdateUserModel,
+    UserExpand,
+    ImportFormat,
+    ImportReportModel,
+    response_users_adapter,
+    response_user_summaries_adapter,
+)
 import app.endpoints.user.security as security
 import app.endpoints.user.service as user_service
-from app.core.database import AsyncSession, get_db
+import app.endpoints.item.service as item_service
+from app.endpoints.item.util import ResponseItemModel, response_items_adapter
+from app.core.config import get_settings
+from app.core.database import AsyncSession, ReadSessionRoute, get_db, get_read_db
+from app.core.deadline import route_timeout
+from app.core.etag import make_etag, etag_matches, not_modified
+from app.core.pagination import MAX_PAGE_SIZE, NEXT_CURSOR_HEADER, encode_cursor, decode_cursor
+from app.core.projection import parse_fields, output_fields
 
 
 auth_router = APIRouter(tags=["Token"])
@@ -18,21 +36,57 @@ async def get_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: Annotated[AsyncSession, Depends(get_db)]
 ):
     user = await security.authenticate_user(form_data.username, form_data.password, db)
-    access_token = security.create_access_token(data={"sub": str(user.id), "scopes": user.get_scopes()})
+    access_token = security.create_access_token(
+        data={"sub": str(user.id), "scopes": user.get_scopes(), "role": user.role.value, "epoch": user.token_epoch}
+    )
     return {"access_token": access_token, "token_type": "bearer"}
 
 
-user_router = APIRouter(prefix="/user", tags=["User"])
+user_router = APIRouter(prefix="/user", tags=["User"], route_class=ReadSessionRoute)
+settings = get_settings()
 
 
 @user_router.get(
     "",
-    response_model=list[ResponseUserModel],
+    response_model=list[ResponseUserSummaryModel] | list[ResponseUserModel],
     dependencies=[Security(security.verify_jwt, scopes=["users:view"])],
-    description="Get the users stored in the database",
+    description="Get the users stored in the database, without their items unless `expand=items` is set. "
+    "Use `fields` to only get some of the fields, the id is always returned. "
+    f"When the page is full, the `{NEXT_CURSOR_HEADER}` header holds the cursor of the next page. "
+    "Answers `304 Not Modified` when the `If-None-Match` header matches the ETag of the page.",
 )
-async def get_users(db: Annotated[AsyncSession, Depends(get_db)]) -> list[ResponseUserModel]:
-    return await user_service.get_users(db=db)
+async def get_users(
+    db: Annotated[AsyncSession, Depends(get_read_db)],
+    filter: Annotated[str, Query(title="Recherche sur le nom ou l'email")] = "",
+    offset: Annotated[int, Query(title="Offset pour la pagination", ge=0)] = 0,
+    limit: Annotated[int, Query(title="Taille de la page : 100 par défaut", ge=1, le=MAX_PAGE_SIZE)] = 100,
+    cursor: Annotated[str | None, Query(title="Curseur de la page suivante, remplace l'offset")] = None,
+    fields: Annotated[str | None, Query(title="Champs à retourner, séparés par des virgules")] = None,
+    expand: Annotated[list[UserExpand], Query(title="Relations à inclure")] = [],
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> Response:
+    try:
+        after = decode_cursor(cursor) if cursor else None
+        projection = parse_fields(fields, ResponseUserSummaryModel)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    include_items = UserExpand.items in expand
+    if if_none_match:
+        etag = await user_service.get_users_etag(
+            db=db, filter=filter, offset=offset, limit=limit, after=after, include_items=include_items
+        )
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+    result = await user_service.get_users(
+        db=db, filter=filter, offset=offset, limit=limit, after=after, include_items=include_items, fields=projection
+    )
+    headers = {"ETag": make_etag(version for user in result for version in user.get_versions())}
+    if result and len(result) == limit:
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(result[-1].created_on, result[-1].id)
+    # Already validated by the service: skip the response_model validation and dump the JSON bytes directly
+    adapter = response_users_adapter if include_items else response_user_summaries_adapter
+    include = {"__all__": output_fields(projection, expand)} if projection else None
+    return Response(content=adapter.dump_json(result, include=include), media_type="application/json", headers=headers)
 
 
 @user_router.post(
@@ -43,21 +97,54 @@ async def get_users(db: Annotated[AsyncSession, Depends(get_db)]) -> list[Respon
     description="Create a new user",
 )
 async def create_user(user: CreateUserModel, db: Annotated[AsyncSession, Depends(get_db)]) -> ResponseUserModel:
-    user.password = security.get_hashed_password(user.password)
+    user.password = await security.get_hashed_password_async(user.password)
     return await user_service.create_user(user=user, db=db)
 
 
+@user_router.post(
+    "/import",
+    response_model=ImportReportModel,
+    dependencies=[Security(security.verify_jwt, scopes=["users:edit"])],
+    description="Import users from a CSV (with an `email,name,password` header) or NDJSON upload, one user per line. "
+    "The body is parsed and hashed as it is uploaded, then written in a single short transaction. "
+    f"Imports over {settings.IMPORT_MAX_LINES} lines are rejected with `413 Content Too Large`. "
+    "The invalid lines and the emails already registered are reported and skipped",
+)
+async def import_users(
+    request: Request,
+    db: Annotated[AsyncSession, Depends(get_db)],
+    format: Annotated[ImportFormat, Query(title="Format de l'import")] = ImportFormat.csv,
+) -> ImportReportModel:
+    # ends the transaction the authentication may have started, so that no connection is held during the upload
+    await db.commit()
+    errors = []
+    chunks = []
+    try:
+        async for chunk in user_service.parse_users_import(request.stream(), format=format, errors=errors):
+            passwords = await security.get_hashed_passwords_async([user.password for user in chunk])
+            chunks.append([user.model_copy(update={"password": password}) for user, password in zip(chunk, passwords)])
+    except user_service.ImportTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    result = await user_service.import_users(chunks, db=db)
+    result.errors = sorted(errors + result.errors, key=lambda error: error.line)
+    return result
+
+
 @user_router.put(
     "",
-    response_model=ResponseUserModel,
+    response_model=ResponseUserSummaryModel | ResponseUserModel,
     status_code=201,
     dependencies=[Security(security.verify_jwt, scopes=["users:edit"])],
-    description="Modify a user",
+    description="Modify a user. The updated user is returned without his items unless `expand=items` is set",
 )
-async def update_user(user: UpdateUserModel, db: Annotated[AsyncSession, Depends(get_db)]) -> ResponseUserModel:
+async def update_user(
+    user: UpdateUserModel,
+    db: Annotated[AsyncSession, Depends(get_db)],
+    expand: Annotated[list[UserExpand], Query(title="Relations à inclure")] = [],
+) -> ResponseUserSummaryModel | ResponseUserModel:
     if user.password is not None:
-        user.password = security.get_hashed_password(user.password)
-    result = await user_service.update_user(user=user, db=db)
+        user.password = await security.get_hashed_password_async(user.password)
+    result = await user_service.update_user(user=user, db=db, include_items=UserExpand.items in expand)
     if not result:
         raise HTTPException(status_code=404, detail="User to update not found")
     return result
@@ -67,30 +154,112 @@ async def update_user(user: UpdateUserModel, db: Annotated[AsyncSession, Depends
     "/count",
     response_model=int,
     dependencies=[Security(security.verify_jwt, scopes=["users:view"])],
-    description="Get the number of users stored in the database",
+    description="Get the number of users stored in the database. Use `exact=false` for a cheap estimate",
 )
-async def get_users_count(db: Annotated[AsyncSession, Depends(get_db)]) -> int:
-    return await user_service.get_users_count(db=db)
+async def get_users_count(
+    db: Annotated[AsyncSession, Depends(get_read_db)],
+    exact: Annotated[bool, Query(title="Compte exact, sinon estimation du planificateur")] = True,
+) -> int:
+    return await user_service.get_users_count(db=db, exact=exact)
 
 
 @user_router.get("/me", response_model=ResponseUserModel, description="Get personnal user informations")
-async def get_user_info(current_user: Annotated[ResponseUserModel, Depends(security.verify_jwt)]):
-    return current_user
+async def get_user_info(
+    current_user: Annotated[Principal, Depends(security.verify_jwt)],
+    db: Annotated[AsyncSession, Depends(get_read_db)],
+) -> ResponseUserModel:
+    result = await user_service.get_user_by_uuid(uuid=current_user.id, db=db)
+    if result is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return result
 
 
 @user_router.get(
     "/{uuid}",
-    response_model=ResponseUserModel,
+    response_model=ResponseUserSummaryModel | ResponseUserModel,
     dependencies=[Security(security.verify_jwt, scopes=["users:view"])],
-    description="Get a user by his uuid primary key",
+    description="Get a user by his uuid primary key, without his items unless `expand=items` is set. "
+    "Use `fields` to only get some of the fields, the id is always returned. "
+    "Answers `304 Not Modified` when the `If-None-Match` header matches the ETag of the user.",
 )
 async def get_user_by_uuid(
-    uuid: Annotated[UUID, Path(title="uuid to query the user")], db: Annotated[AsyncSession, Depends(get_db)]
-) -> ResponseUserModel:
-    result = await user_service.get_user_by_uuid(uuid=uuid, db=db)
+    uuid: Annotated[UUID, Path(title="uuid to query the user")],
+    db: Annotated[AsyncSession, Depends(get_read_db)],
+    fields: Annotated[str | None, Query(title="Champs à retourner, séparés par des virgules")] = None,
+    expand: Annotated[list[UserExpand], Query(title="Relations à inclure")] = [],
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> Response:
+    try:
+        projection = parse_fields(fields, ResponseUserSummaryModel)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    include_items = UserExpand.items in expand
+    if if_none_match:
+        etag = await user_service.get_user_etag(uuid=uuid, db=db, include_items=include_items)
+        if etag is not None and etag_matches(if_none_match, etag):
+            return not_modified(etag)
+    result = await user_service.get_user_by_uuid(uuid=uuid, db=db, include_items=include_items, fields=projection)
     if result is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return result
+    content = result.model_dump_json(include=output_fields(projection, expand) if projection else None)
+    return Response(content=content, media_type="application/json", headers={"ETag": make_etag(result.get_versions())})
+
+
+@user_router.delete(
+    "",
+    response_model=list[UUID],
+    dependencies=[Security(security.verify_jwt, scopes=["users:edit"])],
+    description="Delete several users by their uuid primary keys. Returns the uuids of the deleted users",
+)
+async def delete_users_by_uuids(
+    uuids: Annotated[list[UUID], Body(title="uuids of the users to delete")],
+    db: Annotated[AsyncSession, Depends(get_db)],
+) -> list[UUID]:
+    return await user_service.delete_users_by_uuids(uuids=uuids, db=db)
+
+
+@user_router.get(
+    "/{uuid}/items",
+    response_model=list[ResponseItemModel],
+    dependencies=[
+        Depends(route_timeout(settings.ITEMS_SEARCH_TIMEOUT)),
+        Security(security.verify_jwt, scopes=["users:view", "items:view"]),
+    ],
+    description="Get the items of a user, with the same filter, pagination and fields as `GET /item`",
+)
+async def get_user_items(
+    uuid: Annotated[UUID, Path(title="uuid of the user owning the items")],
+    db: Annotated[AsyncSession, Depends(get_read_db)],
+    filter: Annotated[str, Query(title="Champ de recherche")] = "",
+    offset: Annotated[int, Query(title="Offset pour la pagination", ge=0)] = 0,
+    limit: Annotated[int, Query(title="Taille de la page : 100 par défaut", ge=1, le=MAX_PAGE_SIZE)] = 100,
+    cursor: Annotated[str | None, Query(title="Curseur de la page suivante, remplace l'offset")] = None,
+    fields: Annotated[str | None, Query(title="Champs à retourner, séparés par des virgules")] = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> Response:
+    try:
+        after = decode_cursor(cursor) if cursor else None
+        projection = parse_fields(fields, ResponseItemModel)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if if_none_match:
+        etag = await item_service.get_items_etag(
+            db=db, filter=filter, offset=offset, limit=limit, after=after, user_id=uuid
+        )
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+    result = await item_service.get_items(
+        db=db, filter=filter, offset=offset, limit=limit, after=after, user_id=uuid, fields=projection
+    )
+    # an empty page is the only one that does not tell whether the user exists
+    if not result and await user_service.get_principal(uuid=uuid, db=db) is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    headers = {"ETag": make_etag(version for item in result for version in item.get_versions())}
+    if result and len(result) == limit:
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(result[-1].created_on, result[-1].id)
+    include = {"__all__": output_fields(projection)} if projection else None
+    content = response_items_adapter.dump_json(result, include=include)
+    return Response(content=content, media_type="application/json", headers=headers)
 
 
 @user_router.delete(
@@ -109,14 +278,25 @@ async def delete_user_by_uuid(
 
 @user_router.get(
     "/email/{email}",
-    response_model=ResponseUserModel,
+    response_model=ResponseUserSummaryModel | ResponseUserModel,
     dependencies=[Security(security.verify_jwt, scopes=["users:view"])],
-    description="Get a user by his email",
+    description="Get a user by his email, without his items unless `expand=items` is set. "
+    "Use `fields` to only get some of the fields, the id is always returned.",
 )
 async def get_user_by_email(
-    email: Annotated[EmailStr, Path(title="email to query the user")], db: Annotated[AsyncSession, Depends(get_db)]
-) -> ResponseUserModel:
-    result, _ = await user_service.get_user_with_password_by_email(email=email, db=db)
+    email: Annotated[EmailStr, Path(title="email to query the user")],
+    db: Annotated[AsyncSession, Depends(get_read_db)],
+    fields: Annotated[str | None, Query(title="Champs à retourner, séparés par des virgules")] = None,
+    expand: Annotated[list[UserExpand], Query(title="Relations à inclure")] = [],
+) -> Response:
+    try:
+        projection = parse_fields(fields, ResponseUserSummaryModel)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    result = await user_service.get_user_by_email(
+        email=email, db=db, include_items=UserExpand.items in expand, fields=projection
+    )
     if result is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return result
+    content = result.model_dump_json(include=output_fields(projection, expand) if projection else None)
+    return Response(content=content, media_type="application/json")
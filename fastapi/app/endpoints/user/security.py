@@ -1,5 +1,7 @@
+import asyncio
 from typing import Annotated
 from datetime import datetime, timedelta, timezone
+from hashlib import sha256
 from uuid import UUID
 
 from passlib.context import CryptContext
@@ -11,8 +13,11 @@ from fastapi.security import SecurityScopes, OAuth2PasswordBearer
 from app.core.logger import logger_factory
 from app.core.database import AsyncSession, get_db
 from app.core.config import get_settings
+from app.core.workers import hashing_pool, import_hashing_pool
+from app.core.cache import token_cache
 from app.core.scopes import scopes_description, scopes
-from app.endpoints.user.util import ResponseUserModel
+from app.endpoints.user.util import Principal, UserRole
+from app.endpoints.user.epochs import REVOKED, epoch_table
 import app.endpoints.user.service as user_service
 
 logger = logger_factory(__name__)
@@ -34,6 +39,8 @@ class TokenData(BaseModel):
     uuid: UUID
     scopes: list[str] = []
     epoch_expire: datetime
+    role: UserRole | None = None
+    epoch: int | None = None
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -60,7 +67,45 @@ def get_hashed_password(plain_password: str) -> str:
     return pwd_context.hash(plain_password)
 
 
-def create_access_token(data: dict[str, str | list[scopes] | datetime]) -> str:
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """Runs :func:`verify_password` in the `hashing_pool`, to keep the event loop free during the bcrypt rounds.
+
+    Raises:
+        PoolSaturatedError: when too many passwords are already being hashed.
+    """
+    return await hashing_pool.run(verify_password, plain_password, hashed_password)
+
+
+async def get_hashed_password_async(plain_password: str) -> str:
+    """Runs :func:`get_hashed_password` in the `hashing_pool`, to keep the event loop free during the bcrypt rounds.
+
+    Raises:
+        PoolSaturatedError: when too many passwords are already being hashed.
+    """
+    return await hashing_pool.run(get_hashed_password, plain_password)
+
+
+def get_hashed_passwords(plain_passwords: list[str]) -> list[str]:
+    """Returns the hashed versions of the passwords, see :func:`get_hashed_password`."""
+    return [pwd_context.hash(plain_password) for plain_password in plain_passwords]
+
+
+async def get_hashed_passwords_async(plain_passwords: list[str]) -> list[str]:
+    """Hashes the passwords of an import in parallel, with one job of the `import_hashing_pool` per worker.
+    The import waits for the pool when other imports keep it busy, and never takes the workers of the logins.
+    """
+    workers = import_hashing_pool.max_workers
+    slices = [plain_passwords[i::workers] for i in range(workers)]
+    hashed_slices = await asyncio.gather(
+        *(import_hashing_pool.run(get_hashed_passwords, s, wait=True) for s in slices if s)
+    )
+    result: list[str] = [""] * len(plain_passwords)
+    for i, hashed in enumerate(hashed_slices):
+        result[i::workers] = hashed
+    return result
+
+
+def create_access_token(data: dict[str, str | int | list[scopes] | datetime]) -> str:
     """Creates an access token from the data given. Gives it an expire date based on the settings.
 
     Args:
@@ -76,7 +121,61 @@ def create_access_token(data: dict[str, str | list[scopes] | datetime]) -> str:
     return encoded_token
 
 
-async def authenticate_user(email: str, plain_password: str, db: AsyncSession) -> ResponseUserModel:
+def decode_token(token: str) -> TokenData:
+    """Verifies the signature and the expiration of the token and decodes its data.
+
+    Args:
+        token: the token storing the user's data and permissions.
+
+    Returns:
+        Returns the :class:`TokenData` of the token.
+
+    Raises:
+        JWTError: when the token is invalid or expired.
+        ValidationError: when the data of the token is invalid.
+    """
+    settings = get_settings()
+    decoded_payload = jwt.decode(
+        token=token, key=settings.JWT_SECRET.get_secret_value(), algorithms=[settings.JWT_ALGORITHM]
+    )
+    token_expire = decoded_payload.get("exp")
+    token_uuid = decoded_payload.get("sub")
+    if token_uuid is None or token_expire is None:
+        raise JWTError("Missing claims")
+    token_scopes = decoded_payload.get("scopes", [])
+    return TokenData(
+        scopes=token_scopes,
+        uuid=token_uuid,
+        epoch_expire=token_expire,
+        role=decoded_payload.get("role"),
+        epoch=decoded_payload.get("epoch"),
+    )
+
+
+def get_token_data(token: str) -> TokenData:
+    """Returns the :class:`TokenData` of the token, read through the `token_cache` to skip the signature check
+    and the validation of the tokens already seen. The entries expire with their token.
+
+    Args:
+        token: the token storing the user's data and permissions.
+
+    Returns:
+        Returns the :class:`TokenData` of the token.
+
+    Raises:
+        JWTError: when the token is invalid or expired.
+        ValidationError: when the data of the token is invalid.
+    """
+    key = sha256(token.encode()).digest()
+    token_data = token_cache.get(key)
+    if token_data is None:
+        token_data = decode_token(token)
+        ttl = (token_data.epoch_expire - datetime.now(timezone.utc)).total_seconds()
+        token_cache.set(key, token_data, ttl=ttl)
+    return token_data
+
+
+async def authenticate_user(email: str, plain_password: str, db: AsyncSession) -> Principal:
     """Authenticate the user based on on email and password.
 
     Args:
@@ -84,7 +183,7 @@ async def authenticate_user(email: str, plain_password: str, db: AsyncSession) -
         plain_password: the plain password to compare to the hashed password stored in the database.
 
     Returns:
-        Returns a :class:`ResponseUserModel` of the user if the credentials given were valid. Else returns None.
+        Returns a :class:`Principal` of the user if the credentials given were valid. Else returns None.
 
     Raises:
         HTTPException: when the credentials are invalid. Should propagate to the endpoint to go back in the HTTP Response
@@ -95,7 +194,9 @@ async def authenticate_user(email: str, plain_password: str, db: AsyncSession) -
         headers={"WWW-Authenticate": "Bearer"},
     )
     user, hashed_password = await user_service.get_user_with_password_by_email(email=email, db=db)
-    if user is None or hashed_password is None or not verify_password(plain_password, hashed_password):
+    if user is None or hashed_password is None or user.is_disabled:
+        raise credentials_exception
+    if not await verify_password_async(plain_password, hashed_password):
         raise credentials_exception
     return user
 
@@ -104,15 +205,19 @@ async def verify_jwt(
     security_scopes: SecurityScopes,
     token: Annotated[str, Depends(oauth2_scheme)],
     db: Annotated[AsyncSession, Depends(get_db)],
-) -> ResponseUserModel:
+) -> Principal:
     """Check the validity of the token against database and security_scopes.
+    The user is read through the `principal_cache`, so most requests do not query the database.
+    With `STATELESS_AUTH`, the role and the epoch signed in the token are trusted when the epoch is the current one
+    in the `epoch_table`, and the database is not queried at all. A token carrying a newer epoch than the table, bumped
+    by another instance since the last reload, is checked against the database.
 
     Args:
         security_scopes: The scopes against which to validate the user's permissions encoded in the token.
         token: the token storing the user's data and permissions.
 
     Returns:
-        Returns a :class:`ResponseUserModel` of the user if the credentials given were valid. Else returns None.
+        Returns a :class:`Principal` of the user if the credentials given were valid. Else returns None.
 
     Raises:
         HTTPException: when the credentials are invalid. Should propagate to the endpoint to go back in the HTTP Response
@@ -127,23 +232,28 @@ async def verify_jwt(
         headers={"WWW-Authenticate": authenticate_value},
     )
     try:
-        settings = get_settings()
-        decoded_payload = jwt.decode(
-            token=token, key=settings.JWT_SECRET.get_secret_value(), algorithms=[settings.JWT_ALGORITHM]
-        )
-        token_expire = decoded_payload.get("exp")
-        token_uuid = decoded_payload.get("sub")
-        if token_uuid is None or token_expire is None:
-            raise credentials_exception
-        token_scopes = decoded_payload.get("scopes", [])
-        token_data = TokenData(scopes=token_scopes, uuid=token_uuid, epoch_expire=token_expire)
+        token_data = get_token_data(token)
     except (JWTError, ValidationError) as e:
         raise credentials_exception
-    user = await user_service.get_user_by_uuid(uuid=token_data.uuid, db=db)
+    user = None
+    stateless = get_settings().STATELESS_AUTH and token_data.role is not None and token_data.epoch is not None
+    if stateless:
+        epoch = epoch_table.get(token_data.uuid)
+        if epoch == REVOKED or token_data.epoch < epoch:
+            raise credentials_exception
+        if token_data.epoch == epoch:
+            user = Principal(id=token_data.uuid, role=token_data.role, is_disabled=False, token_epoch=epoch)
+        # else the epoch was bumped by another instance since the last reload, and is checked against the database
     if user is None:
-        raise credentials_exception
+        user = await user_service.get_principal(uuid=token_data.uuid, db=db)
+        if user is None or user.is_disabled:
+            raise credentials_exception
+        if stateless and token_data.epoch != user.token_epoch:
+            raise credentials_exception
+    # the scopes of the token are checked against the current role of the user, in case it was changed since
+    user_scopes = user.get_scopes()
     for scope in security_scopes.scopes:
-        if scope not in token_data.scopes:
+        if scope not in token_data.scopes or scope not in user_scopes:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Not enough permissions",
@@ -1,39 +1,152 @@
+import csv
+import json
+from codecs import getincrementaldecoder
+from collections import defaultdict
+from typing import AsyncIterator, Sequence
 from uuid import UUID
-from dataclasses import asdict
 
-from app.core.database import AsyncSession
-from app.endpoints.user.util import ResponseUserModel, CreateUserModel, UserSchema, UpdateUserModel
+from pydantic import ValidationError
+from sqlalchemy import Row
+
+from app.core.config import get_settings
+from app.core.database import AsyncSession, on_commit
+from app.core.cache import count_cache, item_cache, principal_cache
+from app.core.etag import make_etag
+from app.core.pagination import Cursor
+from app.core.projection import selected_fields, projection_adapter
+from app.endpoints.item.util import ItemSchema
+from app.endpoints.user.util import (
+    Principal,
+    ResponseUserModel,
+    ResponseUserSummaryModel,
+    CreateUserModel,
+    UserSchema,
+    UpdateUserModel,
+    ImportFormat,
+    ImportUserModel,
+    ImportErrorModel,
+    ImportReportModel,
+    response_users_adapter,
+    response_user_summaries_adapter,
+)
+from app.endpoints.user.epochs import epoch_table
 import app.endpoints.user.repository as repository
 
 
-async def get_users(db: AsyncSession) -> list[ResponseUserModel]:
+async def validate_user_rows(
+    rows: Sequence[Row], fields: frozenset[str], include_items: bool, db: AsyncSession
+) -> list[ResponseUserSummaryModel] | list[ResponseUserModel]:
+    """
+    Validates users selected with only some of their columns, loading their items with a single query if asked.
+
+    Args:
+        rows: the rows holding the columns of the users.
+        fields: the requested fields of the users.
+        include_items: if True, the users are returned with their items.
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Returns:
+        A list of projections of :class:`ResponseUserModel` if `include_items` is True,
+        else of :class:`ResponseUserSummaryModel`.
+    """
+    users = [row._asdict() for row in rows]
+    if not include_items:
+        return projection_adapter(ResponseUserSummaryModel, fields).validate_python(users, from_attributes=True)
+    items = defaultdict(list)
+    if users:
+        for item in await repository.get_users_items([user["id"] for user in users], db):
+            items[item.user_id].append(item)
+    for user in users:
+        user["items"] = items[user["id"]]
+    return projection_adapter(ResponseUserModel, fields | {"items"}).validate_python(users, from_attributes=True)
+
+
+async def get_users(
+    db: AsyncSession,
+    filter: str,
+    offset: int,
+    limit: int,
+    after: Cursor | None = None,
+    include_items: bool = False,
+    fields: frozenset[str] | None = None,
+) -> list[ResponseUserSummaryModel] | list[ResponseUserModel]:
     """
     Service layer function to get the users stored in the database.
 
     Args:
         db: The :class:`AsyncSession` to connect to the database.
+        filter: a string to emit a filter on the name or the email of the users.
+        offset: an int to emit an offset on the database query. Ignored when `after` is given.
+        limit: an int to emit a limit on the database query.
+        after: the keyset of the last user of the previous page for keyset pagination.
+        include_items: if True, the users are returned with their items.
+        fields: if given, only these fields are selected from the database, the others are left to None.
 
     Returns:
-        A list of :class:`ResponseUserModel`.
+        A list of :class:`ResponseUserModel` if `include_items` is True, else a list of :class:`ResponseUserSummaryModel`.
     """
-    result = await repository.get_users(db)
-    return [ResponseUserModel.model_validate(s) for s in result]
+    if fields:
+        rows = await repository.get_users(
+            db, filter=filter, offset=offset, limit=limit, after=after, columns=selected_fields(fields)
+        )
+        return await validate_user_rows(rows, fields=fields, include_items=include_items, db=db)
+    result = await repository.get_users(
+        db, filter=filter, offset=offset, limit=limit, after=after, include_items=include_items
+    )
+    adapter = response_users_adapter if include_items else response_user_summaries_adapter
+    return adapter.validate_python(result, from_attributes=True)
 
 
-async def get_users_count(db: AsyncSession) -> int:
+async def get_users_etag(
+    db: AsyncSession,
+    filter: str,
+    offset: int,
+    limit: int,
+    after: Cursor | None = None,
+    include_items: bool = False,
+) -> str:
+    """
+    Service layer function to get the ETag of a page of :func:`get_users` without loading the users.
+
+    Args:
+        db: The :class:`AsyncSession` to connect to the database.
+        filter: a string to emit a filter on the name or the email of the users.
+        offset: an int to emit an offset on the database query. Ignored when `after` is given.
+        limit: an int to emit a limit on the database query.
+        after: the keyset of the last user of the previous page for keyset pagination.
+        include_items: if True, the ETag covers the items of the users.
+
+    Returns:
+        The ETag of the page as a `str`.
+    """
+    result = await repository.get_users_versions(
+        db, filter=filter, offset=offset, limit=limit, after=after, include_items=include_items
+    )
+    return make_etag((row.id, row.updated_on) for row in result)
+
+
+async def get_users_count(db: AsyncSession, exact: bool = True) -> int:
     """
     Service layer function to get the number of users stored in the database.
+    The exact count is cached for `COUNT_CACHE_TTL` seconds and invalidated when a user is created or deleted.
 
     Args:
         db: The :class:`AsyncSession` to connect to the database.
+        exact: if False, returns the planner's estimate instead of counting the rows.
 
     Returns:
         The number of users stored in the database as an integer.
     """
-    return await repository.get_users_count(db)
+    if not exact:
+        return await repository.get_users_count(db, exact=False)
+    result = count_cache.get(UserSchema.__tablename__)
+    if result is None:
+        result = await repository.get_users_count(db)
+        count_cache.set(UserSchema.__tablename__, result)
+    return result
 
 
-async def get_user_with_password_by_email(email: str, db: AsyncSession) -> tuple[ResponseUserModel | None, str | None]:
+async def get_user_with_password_by_email(email: str, db: AsyncSession) -> tuple[Principal | None, str | None]:
     """
     Service layer function to query a user by his email and return the hashed password separately to be able to authenticate the user.
 
@@ -42,26 +155,97 @@ async def get_user_with_password_by_email(email: str, db: AsyncSession) -> tuple
         db: The :class:`AsyncSession` to connect to the database.
 
     Returns:
-        The user correspondinge to the email as a :class:`ResponseUserModel` instance, if present in the database, else None.
+        The user correspondinge to the email as a :class:`Principal` instance, if present in the database, else None.
         The user password as a `str` if the user is present else None.
     """
-    result = await repository.get_user_by_email(email=email, db=db)
-    return ResponseUserModel(**asdict(result)) if result else None, result.password if result else None
+    result = await repository.get_user_with_password_by_email(email=email, db=db)
+    return Principal.model_validate(result) if result else None, result.password if result else None
+
+
+async def get_user_by_email(
+    email: str, db: AsyncSession, include_items: bool = False, fields: frozenset[str] | None = None
+) -> ResponseUserSummaryModel | ResponseUserModel | None:
+    """
+    Service layer function to query a user by his email, without his password.
+
+    Args:
+        email: the string variable to make the query
+        db: The :class:`AsyncSession` to connect to the database.
+        include_items: if True, the user is returned with his items.
+        fields: if given, only these fields are selected from the database, the others are left to None.
+
+    Returns:
+        The user correspondinge to the email as a :class:`ResponseUserModel` instance if `include_items` is True,
+        else as a :class:`ResponseUserSummaryModel` instance, if present in the database, else None.
+    """
+    if fields:
+        row = await repository.get_user_by_email(email=email, db=db, columns=selected_fields(fields))
+        return (await validate_user_rows([row], fields=fields, include_items=include_items, db=db))[0] if row else None
+    result = await repository.get_user_by_email(email=email, db=db, include_items=include_items)
+    model = ResponseUserModel if include_items else ResponseUserSummaryModel
+    return model.model_validate(result) if result else None
 
 
-async def get_user_by_uuid(uuid: UUID, db: AsyncSession) -> ResponseUserModel | None:
+async def get_user_by_uuid(
+    uuid: UUID, db: AsyncSession, include_items: bool = True, fields: frozenset[str] | None = None
+) -> ResponseUserSummaryModel | ResponseUserModel | None:
     """
     Service layer function to query a user by his uuid primary key.
 
+    Args:
+        uuid: the uuid primary key variable to make the query
+        db: The :class:`AsyncSession` to connect to the database.
+        include_items: if True, the user is returned with his items.
+        fields: if given, only these fields are selected from the database, the others are left to None.
+
+    Returns:
+        The user correspondinge to the uuid as a :class:`ResponseUserModel` instance if `include_items` is True,
+        else as a :class:`ResponseUserSummaryModel` instance, if present in the database, else None.
+    """
+    if fields:
+        row = await repository.get_user_by_uuid(uuid=uuid, db=db, columns=selected_fields(fields))
+        return (await validate_user_rows([row], fields=fields, include_items=include_items, db=db))[0] if row else None
+    result = await repository.get_user_by_uuid(uuid=uuid, db=db, include_items=include_items)
+    model = ResponseUserModel if include_items else ResponseUserSummaryModel
+    return model.model_validate(result) if result else None
+
+
+async def get_principal(uuid: UUID, db: AsyncSession) -> Principal | None:
+    """
+    Service layer function to get the authenticated user by his uuid primary key.
+    The result is cached for `PRINCIPAL_CACHE_TTL` seconds and invalidated when the user is updated or deleted.
+
     Args:
         uuid: the uuid primary key variable to make the query
         db: The :class:`AsyncSession` to connect to the database.
 
     Returns:
-        The user correspondinge to the uuid as a :class:`ResponseUserModel` instance, if present in the database, else None.
+        The user corresponding to the uuid as a :class:`Principal` instance, if present in the database, else None.
     """
-    result = await repository.get_user_by_uuid(uuid=uuid, db=db)
-    return ResponseUserModel.model_validate(result) if result else None
+    result = principal_cache.get(uuid)
+    if result is None:
+        row = await repository.get_principal(uuid=uuid, db=db)
+        if row is None:
+            return None
+        result = Principal.model_validate(row)
+        principal_cache.set(uuid, result)
+    return result
+
+
+async def get_user_etag(uuid: UUID, db: AsyncSession, include_items: bool = True) -> str | None:
+    """
+    Service layer function to get the ETag of a user, which covers his items, without loading them.
+
+    Args:
+        uuid: the uuid primary key variable to make the query
+        db: The :class:`AsyncSession` to connect to the database.
+        include_items: if False, the ETag only covers the user.
+
+    Returns:
+        The ETag of the user as a `str`, if present in the database, else None.
+    """
+    result = await repository.get_user_versions(uuid=uuid, db=db, include_items=include_items)
+    return make_etag((row.id, row.updated_on) for row in result) if result else None
 
 
 async def create_user(user: CreateUserModel, db: AsyncSession) -> ResponseUserModel:
@@ -76,22 +260,131 @@ async def create_user(user: CreateUserModel, db: AsyncSession) -> ResponseUserMo
         a :class:`ResponseUserModel` instance corresponding to the user added to the database.
     """
     result: UserSchema = await repository.create_user(user=user, db=db)
+    on_commit(db, count_cache.invalidate, UserSchema.__tablename__)
     return ResponseUserModel.model_validate(result)
 
 
-async def update_user(user: UpdateUserModel, db: AsyncSession) -> ResponseUserModel | None:
+async def iter_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, str]]:
+    """Splits a stream of UTF-8 bytes into numbered lines, starting at 1."""
+    decoder = getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    line_number = 0
+    async for chunk in stream:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            line_number += 1
+            yield line_number, line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield line_number + 1, buffer.rstrip("\r")
+
+
+class ImportTooLargeError(Exception):
+    """Raised when an import has more than `IMPORT_MAX_LINES` lines"""
+
+
+async def parse_users_import(
+    stream: AsyncIterator[bytes], format: ImportFormat, errors: list[ImportErrorModel]
+) -> AsyncIterator[list[ImportUserModel]]:
+    """
+    Service layer function to parse an import of users as it is uploaded. A CSV import starts with a header line.
+
+    Args:
+        stream: the uploaded bytes.
+        format: the :class:`ImportFormat` of the import, one user per line.
+        errors: the list where the invalid lines are reported.
+
+    Yields:
+        The valid users in lists of `BULK_INSERT_CHUNK_SIZE` :class:`ImportUserModel`.
+
+    Raises:
+        ImportTooLargeError: when the import has more than `IMPORT_MAX_LINES` lines.
+    """
+    chunk_size = get_settings().BULK_INSERT_CHUNK_SIZE
+    max_lines = get_settings().IMPORT_MAX_LINES
+    chunk: list[ImportUserModel] = []
+    header: list[str] | None = None
+    async for line_number, line in iter_lines(stream):
+        if line_number > max_lines:
+            raise ImportTooLargeError(f"The import has more than {max_lines} lines")
+        if not line.strip():
+            continue
+        try:
+            if format is ImportFormat.csv:
+                values = next(csv.reader([line]))
+                if header is None:
+                    header = values
+                    continue
+                data = dict(zip(header, values))
+            else:
+                data = json.loads(line)
+                if not isinstance(data, dict):
+                    raise ValueError("Expected a JSON object")
+            chunk.append(ImportUserModel.model_validate({**data, "line": line_number}))
+        except ValidationError as e:
+            detail = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+            errors.append(ImportErrorModel(line=line_number, detail=detail))
+        except (ValueError, csv.Error) as e:
+            errors.append(ImportErrorModel(line=line_number, detail=str(e)))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def import_users(chunks: list[list[ImportUserModel]], db: AsyncSession) -> ImportReportModel:
+    """
+    Service layer function to import users: the chunks are copied in a staging table, then merged in the users table.
+    The lines whose email is already registered, or present on a previous line, are reported and skipped.
+    The users are parsed and hashed beforehand, so that the transaction only lasts for the writes.
+
+    Args:
+        chunks: the users to import with their hashed passwords, in lists of :class:`ImportUserModel`.
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Return:
+        a :class:`ImportReportModel` with the number of users created and the lines skipped.
+    """
+    await repository.create_users_import(db)
+    for chunk in chunks:
+        await repository.copy_users_import(chunk, db)
+    rejects = await repository.get_users_import_rejects(db)
+    created = await repository.merge_users_import(db)
+    if created:
+        on_commit(db, count_cache.invalidate, UserSchema.__tablename__)
+    errors = [
+        ImportErrorModel(
+            line=row.line, detail="Email present on a previous line" if row.duplicate else "Email already registered"
+        )
+        for row in rejects
+    ]
+    return ImportReportModel(created=created, errors=errors)
+
+
+async def update_user(
+    user: UpdateUserModel, db: AsyncSession, include_items: bool = False
+) -> ResponseUserSummaryModel | ResponseUserModel | None:
     """
     Service layer function to update a user from the database.
 
     Args:
         user: The :class:`UpdateUserModel` instance to update from the database.
         db: The :class:`AsyncSession` to connect to the database.
+        include_items: if True, the user is returned with his items.
 
     Return:
-        a :class:`ResponseUserModel` instance corresponding to the user updated to the database or None if the user was not found.
+        the user updated to the database as a :class:`ResponseUserModel` instance if `include_items` is True,
+        else as a :class:`ResponseUserSummaryModel` instance, or None if the user was not found.
     """
-    result = await repository.update_user(user=user, db=db)
-    return ResponseUserModel.model_validate(result) if result else None
+    result = await repository.update_user(user=user, db=db, include_items=include_items)
+    on_commit(db, principal_cache.invalidate, user.id)
+    if result is None:
+        return None
+    on_commit(db, epoch_table.set, user.id, result.token_epoch)
+    model = ResponseUserModel if include_items else ResponseUserSummaryModel
+    return model.model_validate(result)
 
 
 async def delete_user_by_uuid(uuid: UUID, db: AsyncSession) -> bool:
@@ -105,4 +398,35 @@ async def delete_user_by_uuid(uuid: UUID, db: AsyncSession) -> bool:
     Return:
         a `bool` to indicate the success or failure of the operation.
     """
-    return await repository.delete_user_by_uuid(uuid=uuid, db=db)
+    result = await repository.delete_user_by_uuid(uuid=uuid, db=db)
+    if result and get_settings().STATELESS_AUTH:
+        await repository.create_revoked_users([uuid], db)
+    if result:
+        # the user's items are deleted by the ON DELETE CASCADE
+        on_commit(db, count_cache.invalidate, UserSchema.__tablename__, ItemSchema.__tablename__)
+        on_commit(db, item_cache.clear)
+        on_commit(db, principal_cache.invalidate, uuid)
+        on_commit(db, epoch_table.revoke, uuid)
+    return result
+
+
+async def delete_users_by_uuids(uuids: list[UUID], db: AsyncSession) -> list[UUID]:
+    """
+    Service layer function to delete several users from the database.
+
+    Args:
+        uuids: the uuid primary keys of the users to delete.
+        db: The :class:`AsyncSession` to connect to the database.
+
+    Return:
+        the list of the uuids of the users that were deleted.
+    """
+    result = await repository.delete_users_by_uuids(uuids=uuids, db=db)
+    if result and get_settings().STATELESS_AUTH:
+        await repository.create_revoked_users(result, db)
+    if result:
+        on_commit(db, count_cache.invalidate, UserSchema.__tablename__, ItemSchema.__tablename__)
+        on_commit(db, item_cache.clear)
+        on_commit(db, principal_cache.invalidate, *result)
+        on_commit(db, epoch_table.revoke, *result)
+    return result
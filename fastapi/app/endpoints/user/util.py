@@ -2,11 +2,12 @@ from datetime import datetime
 from uuid import UUID
 from enum import Enum
 
-from pydantic import BaseModel, ConfigDict, PastDatetime, EmailStr, Field, model_validator
-from sqlalchemy import func
+from pydantic import BaseModel, ConfigDict, PastDatetime, EmailStr, Field, TypeAdapter, model_validator
+from sqlalchemy import Column, Index, Integer, MetaData, String, Table, func, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from app.core.database import Base
+from app.core.etag import Version
 from app.core.scopes import scopes
 
 from app.endpoints.item.util import ItemSchema, ResponseItemModel
@@ -31,6 +32,19 @@ scopes_dict: dict[UserRole, list[scopes]] = {
 }
 
 
+class UserExpand(str, Enum):
+    """Relationships that can be embedded in the user responses"""
+
+    items = "items"
+
+
+class ImportFormat(str, Enum):
+    """Formats accepted by the users import, one user per line"""
+
+    csv = "csv"
+    ndjson = "ndjson"
+
+
 class UserModel(BaseModel):
     """Base Model of user"""
 
@@ -54,6 +68,29 @@ class CreateUserModel(UserModel):
         return self
 
 
+class ImportUserModel(UserModel):
+    """Model of a line of the users import"""
+
+    line: int
+    email: EmailStr
+    name: str
+    password: str
+
+
+class ImportErrorModel(UserModel):
+    """Model of a line rejected by the users import"""
+
+    line: int
+    detail: str
+
+
+class ImportReportModel(UserModel):
+    """Model returned by the users import"""
+
+    created: int
+    errors: list[ImportErrorModel]
+
+
 class UpdateUserModel(UserModel):
     """Model used for modifying an user"""
 
@@ -63,8 +100,20 @@ class UpdateUserModel(UserModel):
     password: str | None = Field(default=None)
 
 
-class ResponseUserModel(UserModel):
-    """Model returned when converting from UserSchema"""
+class Principal(UserModel):
+    """Model of the authenticated user, holding only what the authorization needs"""
+
+    id: UUID
+    role: UserRole
+    is_disabled: bool
+    token_epoch: int = 0
+
+    def get_scopes(self) -> list[scopes]:
+        return scopes_dict.get(self.role, [])
+
+
+class ResponseUserSummaryModel(UserModel):
+    """Model returned when converting from UserSchema without loading his items"""
 
     model_config = ConfigDict(extra="ignore")
 
@@ -75,32 +124,85 @@ class ResponseUserModel(UserModel):
     created_on: PastDatetime
     updated_on: PastDatetime
     is_disabled: bool
-    items: list[ResponseItemModel]
 
     def get_scopes(self) -> list[scopes]:
         return scopes_dict.get(self.role, [])
 
+    def get_versions(self) -> list[Version]:
+        return [(self.id, self.updated_on)]
+
+
+class ResponseUserModel(ResponseUserSummaryModel):
+    """Model returned when converting from UserSchema"""
+
+    items: list[ResponseItemModel]
+
+    def get_versions(self) -> list[Version]:
+        return [*super().get_versions(), *(version for item in self.items for version in item.get_versions())]
+
+
+# Validate and serialize a whole list in one call, see the list endpoints of the router
+response_users_adapter: TypeAdapter[list[ResponseUserModel]] = TypeAdapter(list[ResponseUserModel])
+response_user_summaries_adapter: TypeAdapter[list[ResponseUserSummaryModel]] = TypeAdapter(
+    list[ResponseUserSummaryModel]
+)
+
 
 class UserSchema(Base):
     """Schema mirroring the users table in the database"""
 
     __tablename__ = "users"
+    __table_args__ = (
+        Index("ix_users_created_on_id", "created_on", "id"),
+        # covers the reloads of the epoch table, which only need the users whose tokens were revoked
+        Index(
+            "ix_users_token_epoch",
+            "id",
+            "token_epoch",
+            "is_disabled",
+            postgresql_where=text("token_epoch > 0 OR is_disabled"),
+        ),
+    )
 
     id: Mapped[UUID] = mapped_column(init=False, primary_key=True, server_default=func.uuid_generate_v4())
     name: Mapped[str] = mapped_column(nullable=False)
     email: Mapped[str] = mapped_column(unique=True)
-    password: Mapped[str] = mapped_column(nullable=False)
+    password: Mapped[str] = mapped_column(nullable=False, repr=False)
     role: Mapped[UserRole] = mapped_column(init=False, nullable=False, insert_default=UserRole.member)
     created_on: Mapped[datetime] = mapped_column(init=False, nullable=False, server_default=func.now())
     updated_on: Mapped[datetime] = mapped_column(
         init=False, nullable=False, onupdate=func.now(), server_default=func.now()
     )
     items: Mapped[list[ItemSchema]] = relationship(
-        init=False, cascade="all, delete-orphan", passive_deletes=True, lazy="joined"
+        init=False, repr=False, cascade="all, delete-orphan", passive_deletes=True, lazy="joined"
     )
     is_disabled: Mapped[bool] = mapped_column(init=False, nullable=False, server_default="false")
-
-    def update_from_model(self, model: UpdateUserModel) -> None:
-        for field, value in model.model_dump().items():
-            if hasattr(self, field) and value is not None:
-                setattr(self, field, value)
+    # bumped by the updates of the user to revoke his tokens, see app.endpoints.user.epochs
+    token_epoch: Mapped[int] = mapped_column(init=False, nullable=False, server_default="0")
+
+
+class RevokedUserSchema(Base):
+    """
+    Schema mirroring the revoked_users table: the users deleted less than `ACCESS_TOKEN_EXPIRE_MINUTES` ago, whose
+    tokens are still rejected by the epoch tables of the other instances.
+    """
+
+    __tablename__ = "revoked_users"
+    __table_args__ = (Index("ix_revoked_users_revoked_on", "revoked_on"),)
+
+    id: Mapped[UUID] = mapped_column(primary_key=True)
+    revoked_on: Mapped[datetime] = mapped_column(init=False, nullable=False, server_default=func.now())
+
+
+# Staging table of the users import, created for the transaction of the import only. Its own MetaData keeps it out
+# of the migrations and of create_all.
+users_import_table = Table(
+    "users_import",
+    MetaData(),
+    Column("line", Integer, nullable=False),
+    Column("email", String, nullable=False),
+    Column("name", String, nullable=False),
+    Column("password", String, nullable=False),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
@@ -1,15 +1,26 @@
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from typing import Any
+from fastapi import FastAPI, Security
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse
 
 from app.core.metadata import TITLE, DESCRIPTION, SUMMARY, VERSION, LICENSE_INFO, CONTACT
-from app.core.config import initialize_app, cleanup_app
+from app.core.config import get_settings, initialize_app, cleanup_app
 from app.core.logger import logger_factory
 from app.core.exception_handlers import register_exception_handlers
+from app.core.pagination import NEXT_CURSOR_HEADER
+from app.core.cache import caches
+from app.core.database import engine, read_engine, get_pool_stats
+from app.core.instrumentation import QueryStatsMiddleware, SERVER_TIMING_HEADER, statement_cache
+from app.core.workers import hashing_pool, import_hashing_pool
+from app.core.warmup import warm_up
 
 from app.endpoints.user.router import user_router, auth_router
+from app.endpoints.user.security import verify_jwt
+from app.endpoints.user.epochs import epoch_table
 from app.endpoints.item.router import router as item_router
+import app.endpoints.item.repository as item_repository
+import app.endpoints.user.repository as user_repository
 
 ROOT_PATH = "/api/v1"  # dans le conteneur docker
 # ROOT_PATH = ""  # pour le developpement en local
@@ -18,8 +29,20 @@ ROOT_PATH = "/api/v1"  # dans le conteneur docker
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     initialize_app()
+    hashing_pool.start()
+    if get_settings().STATELESS_AUTH:
+        epoch_table.start()
+    if get_settings().DB_WARM_UP:
+        engines = [engine] if read_engine is None else [engine, read_engine]
+        warm_up.start(app, engines, [item_repository.warm_up, user_repository.warm_up])
+    else:
+        warm_up.ready = True
     yield
-    cleanup_app()
+    await warm_up.stop()
+    await epoch_table.stop()
+    hashing_pool.shutdown()
+    import_hashing_pool.shutdown()
+    await cleanup_app()
 
 
 logger = logger_factory(__name__)
@@ -44,8 +67,9 @@ app.add_middleware(
     allow_origins=origins,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["content-disposition"],
+    expose_headers=["content-disposition", "etag", NEXT_CURSOR_HEADER, SERVER_TIMING_HEADER],
 )
+app.add_middleware(QueryStatsMiddleware)
 
 
 @app.get("/", response_class=HTMLResponse, tags=["Root"])
@@ -64,6 +88,40 @@ async def root():
     return HTMLResponse(content=html_content)
 
 
+@app.get(
+    "/cache",
+    tags=["System"],
+    dependencies=[Security(verify_jwt, scopes=["system_config"])],
+    description="Get the statistics of the in-process caches and of the statement caches of the database connections",
+)
+async def get_caches_stats() -> dict[str, dict[str, int | float | None]]:
+    return {**{name: cache.stats() for name, cache in caches.items()}, **statement_cache.stats(engine)}
+
+
+@app.get(
+    "/health/pool",
+    tags=["System"],
+    dependencies=[Security(verify_jwt, scopes=["system_config"])],
+    description="Get the state of the database connection pools and the statistics of their checkouts. The pool of the"
+    " read replica, if any, is under `replica`",
+)
+async def get_pool_health() -> dict[str, Any]:
+    stats: dict[str, Any] = get_pool_stats(engine)
+    if read_engine is not None:
+        stats["replica"] = get_pool_stats(read_engine)
+    return stats
+
+
+@app.get(
+    "/health/ready",
+    tags=["System"],
+    description="Answers `503 Service Unavailable` until the warm-up of the application is done, then `200 OK`",
+)
+async def get_readiness() -> JSONResponse:
+    content = {"ready": warm_up.ready, "warm_up_seconds": warm_up.duration}
+    return JSONResponse(status_code=200 if warm_up.ready else 503, content=content)
+
+
 app.include_router(router=item_router)
 app.include_router(router=user_router)
 app.include_router(router=auth_router)
@@ -0,0 +1,47 @@
+"""
+Compares the serialization of the item listing before and after the single validation path of the list endpoints.
+
+Run from /fastapi with : python -m benchmarks.bench_serialization
+"""
+import json
+from datetime import datetime, timedelta, timezone
+from timeit import timeit
+from types import SimpleNamespace
+from uuid import uuid4
+
+from app.endpoints.item.util import ResponseItemModel, response_items_adapter
+
+SIZES = (100, 1_000, 10_000)
+REPEAT = 20
+
+
+def make_rows(size: int) -> list[SimpleNamespace]:
+    """Builds objects exposing the attributes of :class:`ItemSchema` rows."""
+    now = datetime.now(timezone.utc) - timedelta(days=1)
+    user_id = uuid4()
+    return [
+        SimpleNamespace(id=uuid4(), name=f"item {i}", created_on=now, updated_on=now, user_id=user_id)
+        for i in range(size)
+    ]
+
+
+def previous_path(rows: list[SimpleNamespace]) -> bytes:
+    """Validation in the service, then FastAPI's response_model validation and encoding."""
+    models = [ResponseItemModel.model_validate(row) for row in rows]
+    content = [model.model_dump() for model in models]
+    validated = response_items_adapter.validate_python(content)
+    return json.dumps(response_items_adapter.dump_python(validated, mode="json")).encode()
+
+
+def fast_path(rows: list[SimpleNamespace]) -> bytes:
+    """Single validation with the cached TypeAdapter and direct JSON dump."""
+    return response_items_adapter.dump_json(response_items_adapter.validate_python(rows, from_attributes=True))
+
+
+if __name__ == "__main__":
+    print(f"{'rows':>8} {'previous (ms)':>15} {'fast (ms)':>12} {'speedup':>9}")
+    for size in SIZES:
+        rows = make_rows(size)
+        previous = timeit(lambda: previous_path(rows), number=REPEAT) / REPEAT * 1000
+        fast = timeit(lambda: fast_path(rows), number=REPEAT) / REPEAT * 1000
+        print(f"{size:>8} {previous:>15.2f} {fast:>12.2f} {previous / fast:>8.1f}x")